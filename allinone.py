@@ -0,0 +1,459 @@
+"""
+Modo all-in-one: API, expiração e envio de webhooks em um único processo asyncio
+
+Para instalações pequenas. Em vez de API -> Redis -> Monitor -> fila -> Worker,
+as etapas trocam dados em memória: os chats ficam em um dict, as expirações e
+os retries em um timer wheel e os envios em uma asyncio.Queue.
+
+Durabilidade (ALLINONE_STORE):
+- aof: arquivo append-only (ALLINONE_AOF_PATH), reaplicado e compactado no
+  start e sempre que cresce além de ALLINONE_AOF_REWRITE_MB
+- redis: snapshot periódico do estado em uma chave do Redis principal
+- none: só memória (reinício perde chats abertos e envios pendentes)
+"""
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from aiohttp import web
+from dotenv import load_dotenv
+from constants import DEFAULT_DATA_STRUCTURE, REQUIRED_FIELDS
+from connection import get_async_redis
+from flush_policy import POLICY_FIELDS, build_payload, next_expiry, resolve_policy, start_chat, validate_config
+from profiling import install as install_profiling, span
+from worker import WebhookWorker
+
+# Força flush imediato dos prints
+sys.stdout.reconfigure(line_buffering=True)
+
+# Resolução e tamanho do timer wheel
+WHEEL_TICK = 0.05
+WHEEL_SLOTS = 1024
+
+# Intervalo do fsync do arquivo append-only (segundos)
+AOF_FSYNC_INTERVAL = 1
+
+MB = 1024 * 1024
+
+class TimerWheel:
+    """Timer wheel com slots de WHEEL_TICK segundos
+
+    Reagendar ou cancelar uma chave só troca o registro dela; entradas
+    antigas que ficaram nos slots são descartadas quando o slot passa.
+    """
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.time() / tick)
+        self.entries = {}    # chave -> tick em que dispara
+        self.deadlines = {}  # chave -> horário (epoch) em que dispara
+
+    def schedule(self, key, deadline: float):
+        """Agenda (ou reagenda) uma chave para o horário dado"""
+        tick_index = max(int(deadline / self.tick), self.current)
+        self.entries[key] = tick_index
+        self.deadlines[key] = deadline
+        self.slots[tick_index % len(self.slots)].append((tick_index, key))
+
+    def cancel(self, key):
+        self.entries.pop(key, None)
+        self.deadlines.pop(key, None)
+
+    def advance(self, now: float) -> list:
+        """Avança até agora e retorna as chaves vencidas"""
+        target = int(now / self.tick)
+        due = []
+        while self.current <= target:
+            index = self.current % len(self.slots)
+            pending = []
+            for tick_index, key in self.slots[index]:
+                if tick_index > self.current:
+                    pending.append((tick_index, key))  # Próximas voltas
+                elif self.entries.get(key) == tick_index:
+                    due.append(key)
+                    self.cancel(key)
+            self.slots[index] = pending
+            self.current += 1
+        return due
+
+class AppendOnlyFile:
+    """Log append-only do estado, com fsync a cada AOF_FSYNC_INTERVAL
+
+    Como no Redis, é compactado quando passa do tamanho mínimo e dobrou
+    desde a última compactação.
+    """
+
+    def __init__(self, path, rewrite_min_size=64 * MB):
+        self.path = path
+        self.file = None
+        self.dirty = False
+        self.size = 0
+        self.base_size = 0  # Tamanho depois da última compactação
+        self.rewrite_min_size = rewrite_min_size
+
+    def replay(self):
+        """Lê as operações gravadas (ignora uma última linha truncada)"""
+        if not os.path.exists(self.path):
+            return []
+        ops = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ops.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print("⚠️ Linha inválida no AOF ignorada", flush=True)
+        return ops
+
+    def rewrite(self, ops):
+        """Compacta o arquivo com o estado atual e reabre para append"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for op in ops:
+                f.write(json.dumps(op) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file:
+            self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.dirty = False
+        self.size = self.base_size = os.path.getsize(self.path)
+
+    def needs_rewrite(self) -> bool:
+        return self.size >= max(self.rewrite_min_size, 2 * self.base_size)
+
+    def append(self, op):
+        line = json.dumps(op) + "\n"
+        self.file.write(line)
+        self.size += len(line)
+        self.dirty = True
+
+    def sync(self):
+        if self.file and self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+class AllInOne:
+    def __init__(self):
+        load_dotenv()
+        # FLUSH_* inválido derruba a subida, em vez de virar 400 em toda mensagem
+        validate_config()
+
+        self.store = os.getenv('ALLINONE_STORE', 'aof').lower()
+        self.snapshot_interval = float(os.getenv('ALLINONE_SNAPSHOT_INTERVAL', 5))
+        self.snapshot_key = f"allinone:snapshot:{os.getenv('ALLINONE_ID', 'default')}"
+        self.aof = AppendOnlyFile(
+            os.getenv('ALLINONE_AOF_PATH', 'allinone.aof'),
+            rewrite_min_size=float(os.getenv('ALLINONE_AOF_REWRITE_MB', 64)) * MB
+        ) if self.store == 'aof' else None
+        self.redis_client = None
+
+        # Estado em memória
+        self.chats = {}        # user_id -> dados do chat (mesma estrutura do chat:DATA)
+        self.pending = {}      # id do envio -> {"id", "user", "payload", "retry_count"}
+        self.next_id = 1
+        self.wheel = TimerWheel()
+        # Criados no event loop do run(): no Python 3.9 Queue e Event se
+        # prendem ao loop corrente na criação, e o asyncio.run() cria outro
+        self.deliveries = None  # asyncio.Queue de envios
+        self.stopping = None    # asyncio.Event
+
+        # Reaproveita envio, retries e logs do worker
+        self.worker = WebhookWorker()
+
+    # === Estado ===
+
+    def add_message(self, payload: dict, policy: dict, now: float):
+        """Acrescenta a mensagem ao chat e agenda (ou dispara) o flush"""
+        user_id = payload["user"]
+        data = self.chats.get(user_id)
+        if data:
+            data["messages"].append(payload["message"])
+        else:
+            metadata = payload.copy()
+            del metadata["message"]  # Remove a mensagem dos metadados
+            for field in POLICY_FIELDS:  # Remove TTL e política dos metadados
+                metadata.pop(field, None)
+
+            data = DEFAULT_DATA_STRUCTURE.copy()
+            data["metadata"] = metadata
+            data["messages"] = [payload["message"]]
+            data.update(start_chat(policy, now))
+            self.chats[user_id] = data
+
+        expire_in = next_expiry(policy, data, now)
+        self.wheel.schedule(("chat", user_id), now + expire_in)
+        return expire_in
+
+    def flush(self, user_id: str, item_id: int = None, payload: dict = None):
+        """Tira o chat da memória e cria o envio pendente"""
+        data = self.chats.pop(user_id, None)
+        self.wheel.cancel(("chat", user_id))
+        if payload is None:
+            if data is None:
+                return None
+            payload = build_payload(user_id, data)
+        if item_id is None:
+            item_id = self.next_id
+        self.next_id = max(self.next_id, item_id + 1)
+
+        item = {"id": item_id, "user": user_id, "payload": payload, "retry_count": 0}
+        self.pending[item_id] = item
+        return item
+
+    def state_ops(self):
+        """Estado atual como operações (compactação do AOF e snapshot)"""
+        ops = [
+            {"op": "chat", "user": user_id, "data": data,
+             "expires_at": self.wheel.deadlines.get(("chat", user_id), 0)}
+            for user_id, data in self.chats.items()
+        ]
+        ops.extend({"op": "pending", "item": item} for item in self.pending.values())
+        return ops
+
+    def apply(self, op):
+        """Reaplica uma operação gravada"""
+        kind = op["op"]
+        if kind == "msg":
+            self.add_message(op["payload"], op["policy"], op["ts"])
+        elif kind == "chat":
+            self.chats[op["user"]] = op["data"]
+            self.wheel.schedule(("chat", op["user"]), op["expires_at"])
+        elif kind == "flush":
+            self.flush(op["user"], op["id"], op["payload"])
+        elif kind == "pending":
+            item = op["item"]
+            self.pending[item["id"]] = item
+            self.next_id = max(self.next_id, item["id"] + 1)
+        elif kind == "retry":
+            if op["id"] in self.pending:
+                self.pending[op["id"]]["retry_count"] = op["retry_count"]
+        elif kind == "done":
+            self.pending.pop(op["id"], None)
+
+    def record(self, op):
+        if self.aof:
+            self.aof.append(op)
+
+    async def restore(self):
+        """Recupera o estado salvo e reenfileira os envios pendentes"""
+        if self.aof:
+            ops = self.aof.replay()
+            for op in ops:
+                self.apply(op)
+            self.aof.rewrite(self.state_ops())
+            print(f"📂 AOF reaplicado: {len(ops)} operações", flush=True)
+        elif self.store == 'redis':
+            self.redis_client = get_async_redis()
+            raw = await self.redis_client.get(self.snapshot_key)
+            for op in json.loads(raw) if raw else []:
+                self.apply(op)
+            print(f"📂 Snapshot carregado de {self.snapshot_key}", flush=True)
+
+        # Envios pendentes voltam para a fila (entrega pelo menos uma vez)
+        for item in self.pending.values():
+            self.deliveries.put_nowait(item)
+        print(f"♻️ Recuperados {len(self.chats)} chats e {len(self.pending)} envios", flush=True)
+
+    async def persist_loop(self):
+        """fsync do AOF ou snapshot no Redis em intervalos fixos"""
+        interval = AOF_FSYNC_INTERVAL if self.aof else self.snapshot_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.persist()
+            except Exception as e:
+                print(f"❌ Erro ao persistir estado: {str(e)}", flush=True)
+
+    async def persist(self):
+        if self.aof:
+            if self.aof.needs_rewrite():
+                # Sem await no meio: o estado não muda durante a compactação
+                size = self.aof.size
+                self.aof.rewrite(self.state_ops())
+                print(f"🗜️ AOF compactado: {size / MB:.1f}MB -> {self.aof.size / MB:.1f}MB", flush=True)
+            else:
+                self.aof.sync()
+        elif self.redis_client:
+            await self.redis_client.set(self.snapshot_key, json.dumps(self.state_ops()))
+
+    # === Etapas ===
+
+    async def handle_message(self, request):
+        """Mesmo contrato do POST /message da API"""
+        try:
+            payload = await request.json()
+        except Exception:
+            payload = None
+
+        # Validações básicas
+        if not payload:
+            return web.json_response({"error": "Payload vazio"}, status=400)
+
+        for field in REQUIRED_FIELDS:
+            if field not in payload:
+                return web.json_response({"error": f"Campo obrigatório ausente: {field}"}, status=400)
+
+        try:
+            policy = resolve_policy(payload)
+        except ValueError as e:
+            return web.json_response({"error": f"Política de flush inválida: {str(e)}"}, status=400)
+
+        now = time.time()
+        user_id = payload["user"]
+        with span("allinone.add_message"):
+            self.record({"op": "msg", "payload": payload, "policy": policy, "ts": now})
+            expire_in = self.add_message(payload, policy, now)
+
+        if expire_in > 0:
+            message = f"Mensagem salva para usuário {user_id}, expira em {round(expire_in, 1):g} segundos"
+        else:
+            # Limite de mensagens ou espera máxima atingido: vai direto para a fila
+            self.enqueue_flush(user_id)
+            message = f"Mensagem salva para usuário {user_id}, enviada para a fila"
+
+        return web.json_response({"success": True, "message": message})
+
+    async def handle_health(self, request):
+        return web.json_response({
+            "open_chats": len(self.chats),
+            "buffered_messages": sum(len(data["messages"]) for data in self.chats.values()),
+            "pending_deliveries": len(self.pending),
+            "queue_depth": self.deliveries.qsize()
+        })
+
+    def enqueue_flush(self, user_id: str):
+        item = self.flush(user_id)
+        if item:
+            self.record({"op": "flush", "user": user_id, "id": item["id"], "payload": item["payload"]})
+            self.deliveries.put_nowait(item)
+
+    async def timer_loop(self):
+        """Dispara expirações de chats e retries vencidos"""
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for kind, key in self.wheel.advance(time.time()):
+                if kind == "chat":
+                    print(f"✅ Processando chat: {key}", flush=True)
+                    self.enqueue_flush(key)
+                elif kind == "retry" and key in self.pending:
+                    self.deliveries.put_nowait(self.pending[key])
+
+    async def delivery_loop(self):
+        """Consome a fila de envios (um por slot do worker)"""
+        while True:
+            item = await self.deliveries.get()
+            try:
+                await self.deliver(item)
+            except Exception as e:
+                print(f"❌ Erro ao processar envio: {str(e)}", flush=True)
+            finally:
+                self.deliveries.task_done()
+
+    async def deliver(self, item):
+        worker = self.worker
+        retry_count = item["retry_count"]
+
+        # Se passou do limite, descarta
+        if retry_count >= worker.max_retries:
+            print(f"❌ Descartando mensagem após {retry_count} tentativas", flush=True)
+            await worker.save_webhook_log(
+                user_id=item["user"],
+                payload=item["payload"],
+                status="discarded",
+                response={
+                    "error": f"Máximo de {worker.max_retries} tentativas atingido",
+                    "retry_count": retry_count
+                }
+            )
+            self.done(item)
+            return
+
+        with span("allinone.send_webhook"):
+            success = await worker.send_webhook(item["user"], item["payload"])
+        if success:
+            self.done(item)
+            return
+
+        # Agenda retry no timer wheel respeitando o delay da tentativa
+        item["retry_count"] = retry_count + 1
+        delay = worker.retry_delays[min(retry_count, len(worker.retry_delays) - 1)]
+        print(f"⚠️ Tentativa {item['retry_count']}/{worker.max_retries} - Próximo retry em {delay}s", flush=True)
+        self.record({"op": "retry", "id": item["id"], "retry_count": item["retry_count"]})
+        self.wheel.schedule(("retry", item["id"]), time.time() + delay)
+
+    def done(self, item):
+        self.pending.pop(item["id"], None)
+        self.record({"op": "done", "id": item["id"]})
+
+    # === Processo ===
+
+    def request_stop(self, signame: str):
+        print(f"\n🛑 {signame} recebido, salvando o estado e saindo", flush=True)
+        self.stopping.set()
+
+    async def run(self):
+        print("=== INICIANDO ALL-IN-ONE ===", flush=True)
+        print(f"Armazenamento: {self.store}", flush=True)
+        loop = asyncio.get_running_loop()
+        install_profiling("allinone", loop)
+
+        self.deliveries = asyncio.Queue()
+
+        # SIGTERM (deploy) e SIGINT: sai pelo finally, que persiste o estado
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+            except NotImplementedError:
+                pass  # Windows
+
+        await self.restore()
+
+        app = web.Application()
+        app.router.add_post('/message', self.handle_message)  # Rota principal
+        app.router.add_post('/', self.handle_message)         # Rota alternativa
+        app.router.add_get('/health', self.handle_health)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '0.0.0.0', int(os.getenv('ALLINONE_PORT', 5000)))
+        await site.start()
+        print("🚀 All-in-one iniciado", flush=True)
+
+        tasks = [
+            asyncio.create_task(self.timer_loop()),
+            asyncio.create_task(self.persist_loop())
+        ]
+        tasks.extend(asyncio.create_task(self.delivery_loop()) for _ in range(self.worker.max_slots))
+
+        stopper = asyncio.create_task(self.stopping.wait())
+        try:
+            done, _ = await asyncio.wait([stopper, *tasks], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stopper:
+                    task.result()  # Propaga o erro de uma etapa que parou
+        finally:
+            stopper.cancel()
+            for task in tasks:
+                task.cancel()
+            await runner.cleanup()
+            await self.persist()
+            if self.aof:
+                self.aof.close()
+            await self.worker.close()
+            print("👋 All-in-one encerrado", flush=True)
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    asyncio.run(AllInOne().run())
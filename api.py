@@ -1,6 +1,8 @@
 from flask import Flask, request, jsonify
 import redis
 import json
+import hmac
+import time
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -8,23 +10,33 @@ from constants import (
     get_ttl_key,
     get_data_key,
     DEFAULT_DATA_STRUCTURE,
-    REQUIRED_FIELDS,
-    DEFAULT_TTL
+    REQUIRED_FIELDS
 )
+from stats import record_message
+from flush_policy import POLICY_FIELDS, next_expiry, queue_flush, resolve_policy, start_chat, validate_config
+from connection import get_redis
+from ratelimit import RateLimiter, retry_after_header, validate_config as validate_rate_limits
+from profiling import capture_for, install as install_profiling, profiled_call, span, summary
 
 # Carrega variáveis do .env
 load_dotenv()
 
+# FLUSH_* e RATE_LIMIT* inválidos derrubam a subida, em vez de virar
+# 400/500 em toda mensagem
+validate_config()
+validate_rate_limits()
+
 app = Flask(__name__)
 app.config['PREFERRED_URL_SCHEME'] = 'https'  # Para HTTPS
 
-# Conexão com Redis
-redis_client = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=int(os.getenv('REDIS_PORT', 6379)),
-    password=os.getenv('REDIS_PASSWORD'),
-    decode_responses=True
-)
+# Conexão com Redis (pool compartilhado entre as threads do Flask)
+redis_client = get_redis()
+
+# Controle de admissão compartilhado entre todas as réplicas
+rate_limiter = RateLimiter(redis_client)
+
+# Profiling opcional (spans amostrados e capturas via sinal ou /debug/profile)
+install_profiling("api")
 
 @app.route('/message', methods=['POST'])  # Rota principal
 @app.route('/', methods=['POST'])         # Rota alternativa
@@ -56,6 +68,12 @@ def save_message():
             "ttl": 30
         }'
     """
+    with span("api.save_message"), profiled_call():
+        return handle_message()
+
+def handle_message():
+    """Valida, aplica o rate limit e grava a mensagem"""
+    lease = None
     try:
         # Pega o JSON do request
         payload = request.json
@@ -69,18 +87,35 @@ def save_message():
             if field not in payload:
                 return jsonify({"error": f"Campo obrigatório ausente: {field}"}), 400
         
+        # Rate limit por tenant e concorrência global, antes de tocar no storage
+        with span("api.ratelimit"):
+            decision = rate_limiter.acquire(payload)
+        if not decision["allowed"]:
+            response = jsonify({
+                "error": f"Limite de requisições excedido ({decision['reason']})",
+                "retry_after": decision["retry_after"]
+            })
+            response.headers['Retry-After'] = retry_after_header(decision["retry_after"])
+            return response, 429
+        lease = decision["lease"]
+        
         # Usa o campo user como identificador único do chat
         user_id = payload["user"]
         
-        # Pega o TTL do payload ou usa default
-        ttl = payload.get("ttl", DEFAULT_TTL)
+        # Política de flush: payload > tenant > padrão
+        try:
+            policy = resolve_policy(payload)
+        except ValueError as e:
+            return jsonify({"error": f"Política de flush inválida: {str(e)}"}), 400
+        now = time.time()
         
         # Chaves no Redis usando funções auxiliares
         ttl_key = get_ttl_key(user_id)
         data_key = get_data_key(user_id)
         
         # Pega dados existentes ou cria novo
-        current_data = redis_client.get(data_key)
+        with span("api.read"):
+            current_data = redis_client.get(data_key)
         if current_data:
             data = json.loads(current_data)
             # Adiciona nova mensagem à lista existente
@@ -89,28 +124,69 @@ def save_message():
             # Se é primeira mensagem, cria estrutura inicial
             metadata = payload.copy()
             del metadata["message"]  # Remove a mensagem dos metadados
-            if "ttl" in metadata:  # Remove TTL dos metadados
-                del metadata["ttl"]
+            for field in POLICY_FIELDS:  # Remove TTL e política dos metadados
+                metadata.pop(field, None)
             
             data = DEFAULT_DATA_STRUCTURE.copy()
             data["metadata"] = metadata
             data["messages"] = [payload["message"]]
+            data.update(start_chat(policy, now))
         
-        # Salva dados atualizados como string JSON
-        redis_client.set(data_key, json.dumps(data))
+        expire_in = next_expiry(policy, data, now)
         
-        # Atualiza TTL
-        redis_client.set(ttl_key, "", ex=ttl)  # Chave TTL vazia, só para expiração
+        # Salva dados, TTL e contadores em um único round trip
+        pipe = redis_client.pipeline(transaction=False)
+        record_message(pipe, user_id)
+        if expire_in > 0:
+            pipe.set(data_key, json.dumps(data))
+            # Chave TTL vazia, só para expiração
+            pipe.set(ttl_key, "", px=max(1, int(expire_in * 1000)))
+            message = f"Mensagem salva para usuário {user_id}, expira em {round(expire_in, 1):g} segundos"
+        else:
+            # Limite de mensagens ou espera máxima atingido: vai direto para a fila
+            queue_flush(pipe, user_id, data)
+            message = f"Mensagem salva para usuário {user_id}, enviada para a fila"
+        # Libera a vaga de concorrência no mesmo round trip
+        rate_limiter.release(lease, pipe)
+        with span("api.write"):
+            pipe.execute()
+        lease = None
         
         return jsonify({
             "success": True,
-            "message": f"Mensagem salva para usuário {user_id}, expira em {ttl} segundos"
+            "message": message
         })
         
     except Exception as e:
         return jsonify({
             "error": f"Erro ao salvar mensagem: {str(e)}"
         }), 500
+        
+    finally:
+        rate_limiter.release(lease)
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """Resumo dos spans (GET) ou captura sob demanda (POST ?kind=cpu|memory)
+    
+    Só responde com PROFILE_TOKEN configurado e enviado no header X-Profile-Token.
+    """
+    token = os.getenv('PROFILE_TOKEN')
+    if not token or not hmac.compare_digest(request.headers.get('X-Profile-Token', ''), token):
+        return jsonify({"error": "Não encontrado"}), 404
+        
+    if request.method == 'GET':
+        return jsonify(summary())
+        
+    kind = request.args.get('kind', 'cpu')
+    if kind not in ("cpu", "memory"):
+        return jsonify({"error": f"Tipo de captura inválido: {kind}"}), 400
+    if not capture_for(kind):
+        return jsonify({"error": "Já existe uma captura em andamento"}), 409
+    return jsonify({
+        "success": True,
+        "message": f"Captura {kind} iniciada; o arquivo sai em PROFILE_DIR ao final"
+    })
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,308 @@
+"""
+Microbenchmarks dos caminhos por mensagem, contra um Redis local
+
+Mede save_message (API), process_expired_chat (Monitor),
+WebhookWorker.process_message (Worker, com um webhook local) e a
+serialização JSON de um chat típico. Para cada caso:
+
+- ops/s e µs por operação
+- comandos Redis e round trips por operação
+- KiB alocados por operação (tracemalloc, em uma passada separada)
+
+Uso:
+    python bench.py                              # imprime a tabela
+    python bench.py --json > bench_output.txt    # salva como baseline
+    python bench.py --baseline bench_output.txt  # falha (exit 1) se regrediu
+
+Roda em um banco dedicado, BENCH_REDIS_URL (padrão redis://localhost:6379/15),
+e nunca no REDIS_URL do ambiente: os caminhos medidos também mexem em
+contadores globais (stats:*) e no rate limit (ratelimit:*). O banco precisa
+estar vazio no início (ou use --flush) e é esvaziado no final.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Antes de importar os serviços, que conectam no import
+os.environ['REDIS_URL'] = os.getenv('BENCH_REDIS_URL', 'redis://localhost:6379/15')
+os.environ['REDIS_CLUSTER'] = ''
+os.environ['RATE_LIMITS'] = json.dumps({"user": {"rate": 1000000, "burst": 1000000}})
+os.environ.pop('UPSTASH_REDIS_URL', None)
+
+from aiohttp import web
+from redis.connection import Connection
+from constants import REDIS_PREFIX_QUEUE, get_data_key, get_ttl_key
+from connection import get_redis, safe_url
+
+USER_PREFIX = "bench-"
+USERS = 100
+MESSAGES_PER_CHAT = 20
+WEBHOOK_PORT = 8765
+
+# Regressão em comandos/round trips é sempre exata; tempo e memória têm tolerância
+EXACT_METRICS = ("commands", "round_trips")
+TOLERANT_METRICS = ("us_per_op", "alloc_kib")
+
+class RedisCounter:
+    """Conta comandos e round trips enviados pelo redis-py síncrono"""
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.original_command = Connection.send_command
+        self.original_pack = Connection.pack_commands
+        self.original_send = Connection.send_packed_command
+
+    def install(self):
+        counter = self
+
+        def send_command(self, *args, **kwargs):
+            counter.commands += 1
+            return counter.original_command(self, *args, **kwargs)
+
+        def pack_commands(self, commands):
+            # Pipelines empacotam todos os comandos de uma vez
+            counter.commands += len(commands)
+            return counter.original_pack(self, commands)
+
+        def send_packed_command(self, command, check_health=True):
+            counter.round_trips += 1
+            return counter.original_send(self, command, check_health)
+
+        Connection.send_command = send_command
+        Connection.pack_commands = pack_commands
+        Connection.send_packed_command = send_packed_command
+
+    def reset(self):
+        self.commands = 0
+        self.round_trips = 0
+
+counter = RedisCounter()
+
+def sample_payload(i: int) -> dict:
+    return {
+        "user": f"{USER_PREFIX}{i % USERS}",
+        "message": f"Mensagem de teste {i}",
+        "id_agente": 1,
+        "numero_conectado": "+5511999999999",
+        "instance_id": "bench-instance",
+        "ttl": 300
+    }
+
+def sample_chat(i: int) -> dict:
+    return {
+        "messages": [f"Mensagem de teste {n}" for n in range(MESSAGES_PER_CHAT)],
+        "metadata": {
+            "id_agente": 1,
+            "numero_conectado": "+5511999999999",
+            "instance_id": "bench-instance"
+        },
+        "first_at": time.time(),
+        "deadline": None
+    }
+
+def seed_chat(redis_client, i: int):
+    """Chat com MESSAGES_PER_CHAT mensagens, para cada operação partir do mesmo tamanho"""
+    user_id = f"{USER_PREFIX}{i % USERS}"
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(get_data_key(user_id), json.dumps(sample_chat(i)))
+    pipe.set(get_ttl_key(user_id), "1", ex=300)
+    pipe.execute()
+
+# === Casos ===
+# Cada caso é (nome, setup(i), run(i)); só run entra na medição
+
+def api_case(redis_client):
+    import api
+    client = api.app.test_client()
+
+    def setup(i):
+        seed_chat(redis_client, i)
+
+    def run(i):
+        response = client.post('/message', json=sample_payload(i))
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    return "api.save_message", setup, run
+
+def monitor_case(redis_client, loop):
+    import monitor
+
+    def setup(i):
+        seed_chat(redis_client, i)
+
+    def run(i):
+        loop.run_until_complete(monitor.process_expired_chat(get_ttl_key(f"{USER_PREFIX}{i % USERS}")))
+
+    return "monitor.process_expired_chat", setup, run
+
+def worker_case(loop, closers: list):
+    from worker import WebhookWorker
+
+    async def webhook(request):
+        await request.read()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post('/webhook', webhook)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', WEBHOOK_PORT).start())
+
+    worker = WebhookWorker()
+    worker.webhook_url = f"http://127.0.0.1:{WEBHOOK_PORT}/webhook"
+
+    def run(i):
+        user_id = f"{USER_PREFIX}{i % USERS}"
+        message = {"user": user_id, "listamessages": sample_chat(i)["messages"]}
+        loop.run_until_complete(worker.process_message(f"{REDIS_PREFIX_QUEUE}:{user_id}", message))
+
+    async def close():
+        await worker.close()
+        await runner.cleanup()
+
+    closers.append(close)
+    return "worker.process_message", None, run
+
+def json_case():
+    chat = sample_chat(0)
+
+    def run(i):
+        json.loads(json.dumps(chat))
+
+    return "json.roundtrip", None, run
+
+# === Medição ===
+
+def measure(name, setup, run, iterations: int, warmup: int) -> dict:
+    for i in range(warmup):
+        if setup:
+            setup(i)
+        run(i)
+
+    counter.reset()
+    elapsed = 0.0
+    for i in range(iterations):
+        if setup:
+            commands, round_trips = counter.commands, counter.round_trips
+            setup(i)
+            counter.commands, counter.round_trips = commands, round_trips
+        start = time.perf_counter()
+        run(i)
+        elapsed += time.perf_counter() - start
+    commands, round_trips = counter.commands, counter.round_trips
+
+    # Alocações em passada separada: o tracemalloc distorce o tempo
+    alloc_iterations = max(1, iterations // 10)
+    allocated = 0
+    tracemalloc.start()
+    for i in range(alloc_iterations):
+        if setup:
+            setup(i)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run(i)
+        allocated += max(0, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed else 0.0,
+        "us_per_op": elapsed / iterations * 1e6,
+        "commands": commands / iterations,
+        "round_trips": round_trips / iterations,
+        "alloc_kib": allocated / alloc_iterations / 1024,
+    }
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """Lista de regressões em relação ao baseline"""
+    regressions = []
+    for result in results:
+        base = baseline.get(result["name"])
+        if not base:
+            continue
+        for metric in EXACT_METRICS:
+            if result[metric] > base[metric] + 1e-9:
+                regressions.append(f"{result['name']}: {metric} {base[metric]:g} -> {result[metric]:g}")
+        for metric in TOLERANT_METRICS:
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['name']}: {metric} {base[metric]:.1f} -> {result[metric]:.1f} "
+                    f"(+{(result[metric] / base[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+def run_cases(args, redis_client) -> list:
+    counter.install()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    closers = []
+    try:
+        cases = [
+            api_case(redis_client),
+            monitor_case(redis_client, loop),
+            worker_case(loop, closers),
+            json_case()
+        ]
+
+        for name, setup, run in cases:
+            if args.only and args.only not in name:
+                continue
+            results.append(measure(name, setup, run, args.iterations, args.warmup))
+    finally:
+        for close in closers:
+            loop.run_until_complete(close())
+        loop.close()
+        redis_client.flushdb()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks dos caminhos por mensagem")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--only", help="Roda só os casos cujo nome contém este texto")
+    parser.add_argument("--json", action="store_true", help="Saída em JSON (serve de baseline)")
+    parser.add_argument("--baseline", help="Arquivo JSON de uma execução anterior")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Piora aceitável em tempo e memória (0.2 = 20%%)")
+    parser.add_argument("--flush", action="store_true",
+                        help="Esvazia o banco do benchmark antes, se tiver chaves")
+    args = parser.parse_args()
+
+    # Os serviços imprimem muito por mensagem; a saída deles vai para /dev/null
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        redis_client = get_redis()
+        size = redis_client.dbsize()
+        if size and not args.flush:
+            print(f"❌ {safe_url(os.environ['REDIS_URL'])} tem {size} chaves; o benchmark "
+                  "precisa de um banco dedicado e vazio (BENCH_REDIS_URL, ou --flush)", file=sys.stderr)
+            sys.exit(2)
+        redis_client.flushdb()
+        results = run_cases(args, redis_client)
+
+    if args.json:
+        print(json.dumps({result["name"]: result for result in results}, indent=2))
+    else:
+        print(f"{'caso':<32}{'ops/s':>10}{'µs/op':>10}{'cmds/op':>9}{'rtt/op':>8}{'KiB/op':>9}")
+        for result in results:
+            print(f"{result['name']:<32}{result['ops_per_sec']:>10.0f}{result['us_per_op']:>10.1f}"
+                  f"{result['commands']:>9.1f}{result['round_trips']:>8.1f}{result['alloc_kib']:>9.1f}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regressão: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("✅ Sem regressões em relação ao baseline", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Fábrica de conexões Redis compartilhada entre API, Monitor, Worker e Dashboard
+
+Cada URL ganha um único pool por processo, reaproveitado por todos os
+clientes. O parser hiredis é usado automaticamente pelo redis-py quando o
+pacote está instalado. Com REDIS_CLUSTER=true o Redis principal é acessado
+como Redis Cluster (um pool por nó).
+"""
+import os
+import threading
+from urllib.parse import quote, urlparse, urlunparse
+import redis
+import redis.asyncio
+from redis.utils import HIREDIS_AVAILABLE
+from constants import is_cluster_mode
+
+# Pools por processo: (tipo, url) -> pool
+_pools = {}
+_clients = {}
+_lock = threading.Lock()
+
+SSL_CERT_REQS = {
+    "none": None,
+    "optional": "optional",
+    "required": "required",
+}
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+def get_redis_url() -> str:
+    """URL do Redis principal
+
+    Usa REDIS_URL se definida, senão monta a partir de REDIS_HOST,
+    REDIS_PORT, REDIS_PASSWORD e REDIS_SSL.
+    """
+    url = os.getenv('REDIS_URL')
+    if url:
+        return url
+
+    scheme = "rediss" if _env_bool('REDIS_SSL', False) else "redis"
+    password = os.getenv('REDIS_PASSWORD')
+    auth = f":{quote(password, safe='')}@" if password else ""
+    host = os.getenv('REDIS_HOST', 'localhost')
+    port = int(os.getenv('REDIS_PORT', 6379))
+    return f"{scheme}://{auth}{host}:{port}/0"
+
+def get_upstash_url() -> str:
+    """URL do Upstash (logs), sempre com TLS, ou None se não configurado"""
+    url = os.getenv('UPSTASH_REDIS_URL')
+    if not url:
+        return None
+    # Upstash requer TLS mesmo quando a URL vem como redis://
+    if url.startswith("redis://"):
+        url = "rediss://" + url[len("redis://"):]
+    return url
+
+def safe_url(url: str) -> str:
+    """URL sem a senha, para logs"""
+    parts = urlparse(url)
+    if not parts.password:
+        return url
+    netloc = parts.netloc.replace(f":{parts.password}@", ":***@")
+    return urlunparse(parts._replace(netloc=netloc))
+
+def pool_kwargs(url: str) -> dict:
+    """Opções comuns de conexão, lidas do ambiente
+
+    REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, REDIS_SOCKET_TIMEOUT,
+    REDIS_SOCKET_KEEPALIVE, REDIS_HEALTH_CHECK_INTERVAL e
+    REDIS_SSL_CERT_REQS (none, optional ou required; só para rediss://).
+    """
+    kwargs = {
+        "decode_responses": True,
+        "max_connections": int(os.getenv('REDIS_MAX_CONNECTIONS', 50)),
+        "timeout": float(os.getenv('REDIS_POOL_TIMEOUT', 5)),
+        "socket_timeout": float(os.getenv('REDIS_SOCKET_TIMEOUT', 5)),
+        "socket_connect_timeout": float(os.getenv('REDIS_SOCKET_TIMEOUT', 5)),
+        "socket_keepalive": _env_bool('REDIS_SOCKET_KEEPALIVE', True),
+        "health_check_interval": int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+        "retry_on_timeout": True,
+    }
+    if url.startswith("rediss://"):
+        cert_reqs = os.getenv('REDIS_SSL_CERT_REQS', 'required').lower()
+        kwargs["ssl_cert_reqs"] = SSL_CERT_REQS.get(cert_reqs, "required")
+    return kwargs
+
+def _get_pool(kind: str, url: str):
+    key = (kind, url)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool_class = (
+                redis.asyncio.BlockingConnectionPool if kind == "async"
+                else redis.BlockingConnectionPool
+            )
+            pool = pool_class.from_url(url, **pool_kwargs(url))
+            _pools[key] = pool
+            print(f"🔌 Pool {kind} criado para {safe_url(url)} "
+                  f"(hiredis: {'sim' if HIREDIS_AVAILABLE else 'não'})", flush=True)
+        return pool
+
+def cluster_kwargs(url: str) -> dict:
+    """Opções de conexão para Redis Cluster (o pool é por nó)"""
+    kwargs = pool_kwargs(url)
+    del kwargs["timeout"]  # Só existe no BlockingConnectionPool
+    return kwargs
+
+def _new_client(kind: str, url: str):
+    if url == get_redis_url() and is_cluster_mode():
+        cluster_class = redis.asyncio.RedisCluster if kind == "async" else redis.RedisCluster
+        client = cluster_class.from_url(url, **cluster_kwargs(url))
+        print(f"🔌 Cliente cluster {kind} criado para {safe_url(url)} "
+              f"(hiredis: {'sim' if HIREDIS_AVAILABLE else 'não'})", flush=True)
+        return client
+    client_class = redis.asyncio.Redis if kind == "async" else redis.Redis
+    return client_class(connection_pool=_get_pool(kind, url))
+
+def get_redis(url: str = None) -> redis.Redis:
+    """Cliente síncrono com pool compartilhado (Redis principal por padrão)
+
+    Em modo cluster o Redis principal vem como redis.RedisCluster.
+    """
+    url = url or get_redis_url()
+    with _lock:
+        client = _clients.get(url)
+    if client is None:
+        client = _new_client("sync", url)
+        with _lock:
+            client = _clients.setdefault(url, client)
+    return client
+
+def get_async_redis(url: str = None) -> redis.asyncio.Redis:
+    """Cliente asyncio com pool compartilhado (Redis principal por padrão)
+
+    O pool fica preso ao event loop que o usar primeiro. Em modo cluster
+    cada chamada cria um redis.asyncio.RedisCluster; guarde a instância.
+    """
+    url = url or get_redis_url()
+    return _new_client("async", url)
+
+def get_expiry_sources(client) -> list:
+    """Clientes onde escutar notificações de expiração
+
+    Notificações de keyspace são locais a cada nó, então em cluster é
+    preciso assinar cada primário; fora dele, o próprio cliente basta.
+    """
+    if isinstance(client, redis.RedisCluster):
+        return [node.redis_connection for node in client.get_primaries()]
+    return [client]
+
+def get_upstash() -> redis.Redis:
+    """Cliente síncrono do Upstash, ou None se não configurado"""
+    url = get_upstash_url()
+    if not url:
+        return None
+    return get_redis(url)
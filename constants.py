@@ -1,22 +1,109 @@
 """
 Constantes compartilhadas entre API e Monitor
 """
+import os
 
 # Prefixos das chaves no Redis
 REDIS_PREFIX_TTL = "chat:TTL"    # Chave de TTL: chat:TTL:{user_id}
 REDIS_PREFIX_DATA = "chat:DATA"   # Chave de dados: chat:DATA:{user_id}
+REDIS_PREFIX_QUEUE = "chat:QUEUE"  # Fila de envio: chat:QUEUE:{user_id}
+REDIS_PREFIX_INFLIGHT = "chat:INFLIGHT"  # Envios em andamento: chat:INFLIGHT:{user_id}
+REDIS_PREFIX_RETRY = "chat:RETRY"  # Espera até o próximo retry: chat:RETRY:{user_id}
+REDIS_PREFIX_WEBHOOK = "webhook:user"  # Logs de webhook: webhook:user:{user_id}
+REDIS_PREFIX_WEBHOOK_INDEX = "webhook:idx"  # Índices de tentativas: webhook:idx:{tipo}[:{valor}]
+REDIS_PREFIX_RATELIMIT = "ratelimit"  # Buckets de rate limit: ratelimit:{campo}:{valor}
+REDIS_PREFIX_WORKER = "worker"  # Controle dos workers: worker:registry
+
+# Workers vivos (sorted set com score = último heartbeat)
+WORKER_REGISTRY_KEY = f"{REDIS_PREFIX_WORKER}:registry"
+
+def is_cluster_mode() -> bool:
+    """Redis Cluster ativado via REDIS_CLUSTER"""
+    return os.getenv('REDIS_CLUSTER', '').lower() in ("1", "true", "yes", "on")
+
+def user_tag(user_id: str) -> str:
+    """Parte da chave que identifica o usuário
+    
+    Em modo cluster vira hash tag ({user_id}), para que todas as chaves de
+    um usuário caiam no mesmo slot e possam ir juntas em pipelines,
+    scripts e comandos multi-chave.
+    """
+    if is_cluster_mode():
+        return f"{{{user_id}}}"
+    return user_id
 
 def get_ttl_key(user_id: str) -> str:
     """Retorna a chave TTL para um usuário"""
-    return f"{REDIS_PREFIX_TTL}:{user_id}"
+    return f"{REDIS_PREFIX_TTL}:{user_tag(user_id)}"
 
 def get_data_key(user_id: str) -> str:
     """Retorna a chave de dados para um usuário"""
-    return f"{REDIS_PREFIX_DATA}:{user_id}"
+    return f"{REDIS_PREFIX_DATA}:{user_tag(user_id)}"
+
+def get_queue_key(user_id: str) -> str:
+    """Retorna a chave da fila de envio para um usuário"""
+    return f"{REDIS_PREFIX_QUEUE}:{user_tag(user_id)}"
+
+def get_webhook_key(user_id: str) -> str:
+    """Retorna a chave dos logs de webhook de um usuário"""
+    return f"{REDIS_PREFIX_WEBHOOK}:{user_tag(user_id)}"
+
+def get_webhook_index_key(kind: str, value: str = None) -> str:
+    """Retorna a chave de um índice de tentativas de webhook
+    
+    Índices são sorted sets com score = timestamp da tentativa:
+    webhook:idx:all, webhook:idx:status:{status} e webhook:idx:user:{user_id}
+    """
+    if value is None:
+        return f"{REDIS_PREFIX_WEBHOOK_INDEX}:{kind}"
+    if kind == "user":
+        value = user_tag(value)
+    return f"{REDIS_PREFIX_WEBHOOK_INDEX}:{kind}:{value}"
+
+def ratelimit_tag() -> str:
+    """Prefixo das chaves de rate limit
+    
+    Em modo cluster vira hash tag ({ratelimit}): um único script confere
+    todos os buckets e a concorrência, então as chaves precisam do mesmo slot.
+    Limite deliberado: toda admissão roda no shard desse slot (ver README,
+    "Rate Limit na Entrada").
+    """
+    if is_cluster_mode():
+        return f"{{{REDIS_PREFIX_RATELIMIT}}}"
+    return REDIS_PREFIX_RATELIMIT
+
+def get_ratelimit_key(field: str, value: str) -> str:
+    """Retorna a chave do token bucket de um tenant (ex.: ratelimit:instance_id:inst_123)"""
+    return f"{ratelimit_tag()}:{field}:{value}"
+
+def get_ratelimit_inflight_key() -> str:
+    """Retorna o sorted set das vagas de concorrência em uso"""
+    return f"{ratelimit_tag()}:inflight"
+
+def get_inflight_key(user_id: str) -> str:
+    """Retorna o hash dos envios em andamento de um usuário (claim -> worker e mensagem)
+    
+    Fica no mesmo slot da fila, para que tirar da fila e registrar seja atômico.
+    """
+    return f"{REDIS_PREFIX_INFLIGHT}:{user_tag(user_id)}"
+
+def get_retry_key(user_id: str) -> str:
+    """Retorna a chave de espera do retry de um usuário (a fila não é lida enquanto existir)
+    
+    Fica no mesmo slot da fila, para o script de claim conferir as duas.
+    """
+    return f"{REDIS_PREFIX_RETRY}:{user_tag(user_id)}"
+
+def get_user_id_from_key(key: str) -> str:
+    """Extrai o user_id de qualquer chave no formato prefixo:tipo:{user_id}"""
+    user_id = key.split(":", 2)[-1]
+    if user_id.startswith("{") and user_id.endswith("}"):
+        user_id = user_id[1:-1]  # Hash tag do modo cluster
+    return user_id
 
 def get_user_id_from_ttl_key(ttl_key: str) -> str:
     """Extrai o user_id de uma chave TTL"""
-    return ttl_key.split(":")[-1]
+    return get_user_id_from_key(ttl_key)
 
 # Estrutura padrão dos dados
 DEFAULT_DATA_STRUCTURE = {
@@ -29,3 +116,9 @@ REQUIRED_FIELDS = ["user", "message"]
 
 # Tempo padrão de expiração (segundos)
 DEFAULT_TTL = 15
+
+# Status possíveis de uma tentativa de webhook
+WEBHOOK_STATUSES = ["success", "error", "discarded"]
+
+# Retenção dos logs de webhook e dos índices de tentativas (segundos)
+WEBHOOK_LOG_TTL = 60 * 60 * 24 * 2
@@ -1,14 +1,55 @@
-from flask import Flask, render_template_string
-import redis
+from flask import Flask, Response, jsonify, render_template_string, request, stream_with_context, url_for
 import json
 import os
+import queue
+import time
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
+from constants import (
+    REDIS_PREFIX_DATA,
+    REDIS_PREFIX_QUEUE,
+    REDIS_PREFIX_WEBHOOK,
+    WEBHOOK_STATUSES,
+    get_data_key,
+    get_queue_key,
+    get_retry_key,
+    get_webhook_key,
+    get_webhook_index_key,
+    get_user_id_from_key
+)
+from stats import read_summary
+from connection import get_redis, get_upstash
 
 load_dotenv()
 
 app = Flask(__name__)
 
+# Tempo de vida do snapshot compartilhado entre todos os viewers (segundos)
+CACHE_TTL = float(os.getenv('DASHBOARD_CACHE_TTL', 3))
+# Paginação
+PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', 20))
+MAX_PAGE_SIZE = 100
+# Dica de tamanho de lote para o SCAN
+SCAN_COUNT = 500
+# Quantas mensagens mostrar de cada fila
+QUEUE_PREVIEW = 5
+# Limite de páginas guardadas em cache por snapshot
+MAX_CACHED_PAGES = 256
+# Intervalo entre verificações do change feed (segundos)
+FEED_INTERVAL = float(os.getenv('DASHBOARD_FEED_INTERVAL', 1))
+# Deltas pendentes por stream antes de derrubar um cliente lento
+FEED_BACKLOG = 100
+# Marca de fim enviada a um stream derrubado
+FEED_CLOSED = object()
+# Intervalo do heartbeat do SSE (segundos)
+SSE_HEARTBEAT = 15
+# Paginação da busca de entregas
+DELIVERIES_LIMIT = 50
+MAX_DELIVERIES_LIMIT = 500
+# Lotes lidos do índice quando há filtro extra (status dentro do índice do usuário)
+MAX_INDEX_BATCHES = 10
+
 # HTML template
 HTML = """
 <!DOCTYPE html>
@@ -42,45 +83,214 @@ HTML = """
         }
     </style>
     <script>
-        function refreshPage() {
-            location.reload();
+        // Seções na primeira página recebem itens novos ao vivo
+        const LIVE_INSERT = {{ live_insert|tojson }};
+        const USER_FILTER = {{ user_filter|tojson }};
+        const PAYLOAD_URLS = {
+            webhook: {{ url_for('webhook_payload', user_id='__USER__')|tojson }},
+            queue: {{ url_for('queue_payload', user_id='__USER__')|tojson }},
+            chat: {{ url_for('chat_payload', user_id='__USER__')|tojson }}
+        };
+        
+        function payloadUrl(kind, userId, index) {
+            let url = PAYLOAD_URLS[kind].replace('__USER__', encodeURIComponent(userId));
+            if (kind === 'webhook') {
+                url += `?index=${index}`;
+            }
+            return url;
+        }
+        
+        function escapeHtml(text) {
+            const div = document.createElement('div');
+            div.textContent = String(text);
+            return div.innerHTML;
         }
-        setInterval(refreshPage, 5000);
         
-        function togglePayload(id) {
-            const el = document.getElementById(id);
+        // Payloads são carregados sob demanda, só quando abertos
+        async function togglePayload(button) {
+            const el = button.closest('.payload-toggle').querySelector('.payload');
             if (el.style.display === 'none') {
+                if (!el.dataset.loaded) {
+                    const response = await fetch(button.dataset.url);
+                    const data = await response.json();
+                    el.querySelector('code').textContent = JSON.stringify(data, null, 2);
+                    el.dataset.loaded = '1';
+                }
                 el.style.display = 'block';
             } else {
                 el.style.display = 'none';
             }
         }
+        
+        function payloadBlock(label, url) {
+            return `<div class="payload-toggle">
+                <button class="btn btn-sm btn-outline-secondary" data-url="${escapeHtml(url)}"
+                        onclick="togglePayload(this)">${label}</button>
+                <div class="payload mt-2" style="display: none;"><pre><code></code></pre></div>
+            </div>`;
+        }
+        
+        function findItem(section, userId) {
+            for (const el of document.querySelectorAll(`#list-${section} > [data-user]`)) {
+                if (el.dataset.user === userId) {
+                    return el;
+                }
+            }
+            return null;
+        }
+        
+        function insertItem(section, userId, html) {
+            if (!LIVE_INSERT[section] || !userId.includes(USER_FILTER)) {
+                return;
+            }
+            document.getElementById(`list-${section}`).insertAdjacentHTML('afterbegin', html);
+        }
+        
+        function removeItem(section, userId) {
+            const el = findItem(section, userId);
+            if (el) {
+                el.remove();
+            }
+        }
+        
+        function attemptHtml(attempt) {
+            const label = attempt.status === 'success'
+                ? '<span class="text-success">✅ Sucesso</span>'
+                : attempt.status === 'error'
+                    ? '<span class="text-danger">❌ Erro</span>'
+                    : `<span class="text-warning">⚠️ ${escapeHtml(attempt.status)}</span>`;
+            return `<div class="attempt ${escapeHtml(attempt.status)} payload-toggle">
+                <div class="d-flex justify-content-between align-items-start">
+                    <div>
+                        <strong>Status:</strong> ${label}<br>
+                        <small class="text-muted">${escapeHtml(attempt.timestamp)}</small>
+                    </div>
+                    <button class="btn btn-sm btn-outline-secondary" onclick="togglePayload(this)"
+                            data-url="${escapeHtml(payloadUrl('webhook', attempt.user_id, attempt.index))}">
+                        Ver Payload
+                    </button>
+                </div>
+                <div class="payload mt-2" style="display: none;"><pre><code></code></pre></div>
+            </div>`;
+        }
+        
+        function applyDelta(delta) {
+            for (const [section, total] of Object.entries(delta.totals || {})) {
+                document.getElementById(`count-${section}`).textContent = total;
+            }
+            
+            for (const userId of delta.chats_added || []) {
+                insertItem('chats', userId, `<div class="mb-3 p-2 border rounded" data-user="${escapeHtml(userId)}">
+                    <strong>Usuário:</strong> ${escapeHtml(userId)}<br>
+                    <div class="mt-2">${payloadBlock('Ver Dados', payloadUrl('chat', userId))}</div>
+                </div>`);
+            }
+            for (const userId of delta.chats_removed || []) {
+                removeItem('chats', userId);
+            }
+            
+            for (const [userId, size] of Object.entries(delta.queues_changed || {})) {
+                const el = findItem('queues', userId);
+                if (el) {
+                    el.querySelector('.queue-size').textContent = size;
+                    delete el.querySelector('.payload').dataset.loaded;
+                } else {
+                    insertItem('queues', userId, `<div class="mb-3 p-2 border rounded" data-user="${escapeHtml(userId)}">
+                        <strong>Usuário:</strong> ${escapeHtml(userId)}<br>
+                        <strong>Mensagens:</strong> <span class="queue-size">${size}</span><br>
+                        <div class="mt-2">${payloadBlock('Ver Mensagens', payloadUrl('queue', userId))}</div>
+                    </div>`);
+                }
+            }
+            for (const userId of delta.queues_removed || []) {
+                removeItem('queues', userId);
+            }
+            
+            for (const attempt of delta.deliveries || []) {
+                const el = findItem('webhooks', attempt.user_id);
+                if (el) {
+                    el.querySelector('.total-attempts').textContent = attempt.total_attempts;
+                    el.querySelector('.updated-at').textContent = attempt.timestamp;
+                    el.querySelector('.attempts').insertAdjacentHTML('beforeend', attemptHtml(attempt));
+                } else {
+                    insertItem('webhooks', attempt.user_id, `<div class="mb-4 p-3 border rounded" data-user="${escapeHtml(attempt.user_id)}">
+                        <h6>Usuário: ${escapeHtml(attempt.user_id)}</h6>
+                        <div class="text-muted small">
+                            Total tentativas: <span class="total-attempts">${attempt.total_attempts}</span><br>
+                            Última atualização: <span class="updated-at">${escapeHtml(attempt.timestamp)}</span>
+                        </div>
+                        <div class="mt-3"><h6>Tentativas:</h6><div class="attempts">${attemptHtml(attempt)}</div></div>
+                    </div>`);
+                }
+            }
+        }
+        
+        document.addEventListener('DOMContentLoaded', () => {
+            const status = document.getElementById('live-status');
+            const source = new EventSource({{ url_for('events')|tojson }});
+            source.addEventListener('delta', (event) => applyDelta(JSON.parse(event.data)));
+            // Stream descartado por ficar para trás: deltas perdidos, recarrega tudo
+            source.addEventListener('resync', () => { source.close(); location.reload(); });
+            source.onopen = () => { status.textContent = '● ao vivo'; status.className = 'text-success'; };
+            source.onerror = () => { status.textContent = '● reconectando'; status.className = 'text-warning'; };
+        });
     </script>
 </head>
 <body>
+    {% macro pager(param, page) %}
+    {% if page.pages > 1 %}
+    <nav class="mt-2">
+        <ul class="pagination pagination-sm mb-0">
+            <li class="page-item {% if page.number <= 1 %}disabled{% endif %}">
+                <a class="page-link" href="{{ page_url(param, page.number - 1) }}">&laquo;</a>
+            </li>
+            <li class="page-item disabled">
+                <span class="page-link">{{ page.number }} / {{ page.pages }}</span>
+            </li>
+            <li class="page-item {% if page.number >= page.pages %}disabled{% endif %}">
+                <a class="page-link" href="{{ page_url(param, page.number + 1) }}">&raquo;</a>
+            </li>
+        </ul>
+    </nav>
+    {% endif %}
+    {% endmacro %}
     <div class="container mt-4">
         <h1>Redis Dashboard</h1>
+        <form class="row g-2 mt-2" method="get">
+            <div class="col-auto">
+                <input type="text" class="form-control form-control-sm" name="user"
+                       placeholder="Filtrar por usuário" value="{{ user_filter }}">
+            </div>
+            <div class="col-auto">
+                <button type="submit" class="btn btn-sm btn-primary">Filtrar</button>
+            </div>
+            <div class="col-auto small align-self-center">
+                <span id="live-status" class="text-muted">● conectando</span>
+            </div>
+        </form>
         <div class="row mt-4">
             <!-- Webhooks -->
             <div class="col-md-12 mb-4">
                 <div class="card">
                     <div class="card-header bg-primary text-white">
-                        <h5 class="card-title mb-0">📝 Logs de Webhook ({{ webhooks|length }})</h5>
+                        <h5 class="card-title mb-0">📝 Logs de Webhook (<span id="count-webhooks">{{ webhooks.total }}</span>)</h5>
                     </div>
                     <div class="card-body">
-                        {% for webhook in webhooks %}
-                        <div class="mb-4 p-3 border rounded">
+                        <div id="list-webhooks">
+                        {% for webhook in webhooks["items"] %}
+                        <div class="mb-4 p-3 border rounded" data-user="{{ webhook.user_id }}">
                             <h6>Usuário: {{ webhook.user_id }}</h6>
                             <div class="text-muted small">
                                 Criado em: {{ webhook.created_at }}<br>
-                                Total tentativas: {{ webhook.total_attempts }}<br>
-                                Última atualização: {{ webhook.updated_at }}
+                                Total tentativas: <span class="total-attempts">{{ webhook.total_attempts }}</span><br>
+                                Última atualização: <span class="updated-at">{{ webhook.updated_at }}</span>
                             </div>
                             
                             <div class="mt-3">
                                 <h6>Tentativas:</h6>
+                                <div class="attempts">
                                 {% for attempt in webhook.attempts %}
-                                <div class="attempt {{ attempt.status }}">
+                                <div class="attempt {{ attempt.status }} payload-toggle">
                                     <div class="d-flex justify-content-between align-items-start">
                                         <div>
                                             <strong>Status:</strong> 
@@ -94,23 +304,20 @@ HTML = """
                                             <br>
                                             <small class="text-muted">{{ attempt.timestamp }}</small>
                                         </div>
-                                        <button class="btn btn-sm btn-outline-secondary" 
-                                                onclick="togglePayload('payload-{{ loop.index }}-{{ webhook.user_id }}')">
+                                        <button class="btn btn-sm btn-outline-secondary" onclick="togglePayload(this)"
+                                                data-url="{{ url_for('webhook_payload', user_id=webhook.user_id, index=loop.index0) }}">
                                             Ver Payload
                                         </button>
                                     </div>
-                                    <div id="payload-{{ loop.index }}-{{ webhook.user_id }}" style="display: none;" class="mt-2">
-                                        <pre><code>{{ attempt.payload|tojson(indent=2) }}</code></pre>
-                                        {% if attempt.response %}
-                                        <strong>Resposta:</strong>
-                                        <pre><code>{{ attempt.response|tojson(indent=2) }}</code></pre>
-                                        {% endif %}
-                                    </div>
+                                    <div class="payload mt-2" style="display: none;"><pre><code></code></pre></div>
                                 </div>
                                 {% endfor %}
+                                </div>
                             </div>
                         </div>
                         {% endfor %}
+                        </div>
+                        {{ pager("page_webhooks", webhooks) }}
                     </div>
                 </div>
             </div>
@@ -119,27 +326,26 @@ HTML = """
             <div class="col-md-6 mb-4">
                 <div class="card">
                     <div class="card-header bg-success text-white">
-                        <h5 class="card-title mb-0">📥 Filas ({{ queues|length }})</h5>
+                        <h5 class="card-title mb-0">📥 Filas (<span id="count-queues">{{ queues.total }}</span>)</h5>
                     </div>
                     <div class="card-body">
-                        {% for queue in queues %}
-                        <div class="mb-3 p-2 border rounded">
+                        <div id="list-queues">
+                        {% for queue in queues["items"] %}
+                        <div class="mb-3 p-2 border rounded" data-user="{{ queue.user_id }}">
                             <strong>Fila:</strong> {{ queue.name }}<br>
-                            <strong>Mensagens:</strong> {{ queue.size }}<br>
-                            <strong>TTL:</strong> {{ queue.ttl }}s<br>
-                            {% if queue.messages %}
-                            <div class="mt-2">
-                                <button class="btn btn-sm btn-outline-secondary" 
-                                        onclick="togglePayload('queue-{{ loop.index }}')">
+                            <strong>Mensagens:</strong> <span class="queue-size">{{ queue.size }}</span><br>
+                            {% if queue.retry_in > 0 %}<strong>Próximo retry:</strong> {{ queue.retry_in }}s<br>{% endif %}
+                            <div class="mt-2 payload-toggle">
+                                <button class="btn btn-sm btn-outline-secondary" onclick="togglePayload(this)"
+                                        data-url="{{ url_for('queue_payload', user_id=queue.user_id) }}">
                                     Ver Mensagens
                                 </button>
-                                <div id="queue-{{ loop.index }}" style="display: none;" class="mt-2">
-                                    <pre><code>{{ queue.messages|tojson(indent=2) }}</code></pre>
-                                </div>
+                                <div class="payload mt-2" style="display: none;"><pre><code></code></pre></div>
                             </div>
-                            {% endif %}
                         </div>
                         {% endfor %}
+                        </div>
+                        {{ pager("page_queues", queues) }}
                     </div>
                 </div>
             </div>
@@ -148,25 +354,26 @@ HTML = """
             <div class="col-md-6">
                 <div class="card">
                     <div class="card-header bg-info text-white">
-                        <h5 class="card-title mb-0">💬 Chats ({{ chats|length }})</h5>
+                        <h5 class="card-title mb-0">💬 Chats (<span id="count-chats">{{ chats.total }}</span>)</h5>
                     </div>
                     <div class="card-body">
-                        {% for chat in chats %}
-                        <div class="mb-3 p-2 border rounded">
+                        <div id="list-chats">
+                        {% for chat in chats["items"] %}
+                        <div class="mb-3 p-2 border rounded" data-user="{{ chat.user_id }}">
                             <strong>Chat:</strong> {{ chat.id }}<br>
                             <strong>Usuário:</strong> {{ chat.user_id }}<br>
                             <strong>Mensagens:</strong> {{ chat.messages }}<br>
-                            <div class="mt-2">
-                                <button class="btn btn-sm btn-outline-secondary" 
-                                        onclick="togglePayload('chat-{{ loop.index }}')">
+                            <div class="mt-2 payload-toggle">
+                                <button class="btn btn-sm btn-outline-secondary" onclick="togglePayload(this)"
+                                        data-url="{{ url_for('chat_payload', user_id=chat.user_id) }}">
                                     Ver Dados
                                 </button>
-                                <div id="chat-{{ loop.index }}" style="display: none;" class="mt-2">
-                                    <pre><code>{{ chat.data|tojson(indent=2) }}</code></pre>
-                                </div>
+                                <div class="payload mt-2" style="display: none;"><pre><code></code></pre></div>
                             </div>
                         </div>
                         {% endfor %}
+                        </div>
+                        {{ pager("page_chats", chats) }}
                     </div>
                 </div>
             </div>
@@ -177,56 +384,515 @@ HTML = """
 """
 
 def connect_redis():
-    return redis.Redis(
-        host=os.getenv('REDIS_HOST'),
-        port=int(os.getenv('REDIS_PORT')),
-        password=os.getenv('REDIS_PASSWORD'),
-        decode_responses=True
-    )
+    """Cliente compartilhado; o pool é reaproveitado entre requests"""
+    return get_redis()
 
-@app.route('/')
-def dashboard():
-    redis_client = connect_redis()
+def connect_logs():
+    """Cliente do Upstash, onde o worker grava logs e índices de webhook
+    
+    None se UPSTASH_REDIS_URL não estiver configurada (o worker também não
+    grava logs nesse caso).
+    """
+    return get_upstash()
+
+def client_for(section, redis_client):
+    """Cliente de onde vêm as chaves da seção"""
+    return connect_logs() if section == "webhooks" else redis_client
+
+# Snapshot compartilhado: chaves de cada seção + páginas já buscadas
+_snapshot = {"built_at": 0.0, "keys": None, "pages": {}}
+_snapshot_lock = threading.Lock()
+
+SECTIONS = {
+    "webhooks": f"{REDIS_PREFIX_WEBHOOK}:*",
+    "queues": f"{REDIS_PREFIX_QUEUE}:*",
+    "chats": f"{REDIS_PREFIX_DATA}:*",
+}
+
+def scan_keys(redis_client, pattern):
+    """Lista chaves com SCAN (não bloqueia o Redis como o KEYS)"""
+    return sorted(set(redis_client.scan_iter(match=pattern, count=SCAN_COUNT)))
+
+def fetch_webhooks(redis_client, keys):
+    """Busca os logs de webhook de uma página em um único round trip
+    
+    Payloads e respostas ficam de fora; são carregados sob demanda.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
     
-    # Webhooks
     webhooks = []
-    for key in redis_client.keys("webhook:user:*"):
-        data = json.loads(redis_client.get(key))
-        webhooks.append(data)  # Agora pegamos todos os dados
+    for raw in pipe.execute():
+        if not raw:
+            continue
+        data = json.loads(raw)
+        data["attempts"] = [
+            {"status": attempt.get("status"), "timestamp": attempt.get("timestamp")}
+            for attempt in data.get("attempts", [])
+        ]
+        webhooks.append(data)
+    return webhooks
+
+def fetch_queues(redis_client, keys):
+    """Busca tamanho e espera de retry das filas em um único round trip"""
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.llen(key)
+        pipe.ttl(get_retry_key(get_user_id_from_key(key)))
+    results = pipe.execute()
     
-    # Filas
     queues = []
-    for key in redis_client.keys("chat:QUEUE:*"):
-        messages = []
-        # Pega até 5 mensagens da fila sem remover
-        for i in range(min(5, redis_client.llen(key))):
-            msg = redis_client.lindex(key, i)
-            if msg:
-                messages.append(json.loads(msg))
-                
+    for i, key in enumerate(keys):
+        size, retry_in = results[i * 2:i * 2 + 2]
+        if not size:
+            continue  # Fila consumida entre o SCAN e a busca
         queues.append({
             'name': key,
-            'size': redis_client.llen(key),
-            'ttl': redis_client.ttl(key),
-            'messages': messages
+            'user_id': get_user_id_from_key(key),
+            'size': size,
+            'retry_in': retry_in
         })
+    return queues
+
+def fetch_chats(redis_client, keys):
+    """Busca os dados dos chats de uma página em um único round trip"""
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
     
-    # Chats
     chats = []
-    for key in redis_client.keys("chat:DATA:*"):
-        data = json.loads(redis_client.get(key))
+    for key, raw in zip(keys, pipe.execute()):
+        if not raw:
+            continue  # Chat expirado entre o SCAN e a busca
+        data = json.loads(raw)
         chats.append({
             'id': key,
-            'user_id': data.get('user_id', 'N/A'),
-            'messages': len(data.get('messages', [])),
-            'data': data
+            'user_id': get_user_id_from_key(key),
+            'messages': len(data.get('messages', []))
         })
+    return chats
+
+FETCHERS = {
+    "webhooks": fetch_webhooks,
+    "queues": fetch_queues,
+    "chats": fetch_chats,
+}
+
+def get_snapshot(redis_client):
+    """Retorna o snapshot de chaves, reconstruindo se estiver velho
+    
+    Deve ser chamado com _snapshot_lock adquirido.
+    """
+    now = time.monotonic()
+    if _snapshot["keys"] is None or now - _snapshot["built_at"] >= CACHE_TTL:
+        keys = {}
+        for section, pattern in SECTIONS.items():
+            client = client_for(section, redis_client)
+            keys[section] = scan_keys(client, pattern) if client else []
+        _snapshot["keys"] = keys
+        _snapshot["pages"] = {}
+        _snapshot["built_at"] = now
+    return _snapshot
+
+def get_page(redis_client, section, user_filter="", number=1, per_page=PAGE_SIZE):
+    """Retorna uma página de uma seção, filtrada por usuário
+    
+    Páginas ficam em cache junto com o snapshot, então vários viewers
+    olhando a mesma página geram uma única busca no Redis.
+    """
+    with _snapshot_lock:
+        snapshot = get_snapshot(redis_client)
+        cache_key = (section, user_filter, number, per_page)
+        if cache_key in snapshot["pages"]:
+            return snapshot["pages"][cache_key]
+        
+        keys = snapshot["keys"][section]
+        if user_filter:
+            keys = [k for k in keys if user_filter in get_user_id_from_key(k)]
+        
+        pages = max(1, -(-len(keys) // per_page))
+        number = min(max(1, number), pages)
+        start = (number - 1) * per_page
+        
+        # Sem Upstash a seção de webhooks fica vazia
+        client = client_for(section, redis_client)
+        page = {
+            'items': FETCHERS[section](client, keys[start:start + per_page]) if client else [],
+            'total': len(keys),
+            'number': number,
+            'pages': pages
+        }
+        
+        if len(snapshot["pages"]) >= MAX_CACHED_PAGES:
+            snapshot["pages"].clear()
+        snapshot["pages"][cache_key] = page
+        return page
+
+def get_int_arg(name, default, maximum=None):
+    """Lê um parâmetro inteiro da query string"""
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        value = default
+    if maximum is not None:
+        value = min(value, maximum)
+    return max(1, value)
+
+def page_url(param, number):
+    """Monta a URL da página mantendo os outros parâmetros"""
+    args = request.args.to_dict()
+    args[param] = number
+    return url_for('dashboard', **args)
+
+@app.route('/')
+def dashboard():
+    redis_client = connect_redis()
+    
+    user_filter = request.args.get('user', '').strip()
+    per_page = get_int_arg('per_page', PAGE_SIZE, MAX_PAGE_SIZE)
+    
+    webhooks = get_page(redis_client, "webhooks", user_filter,
+                        get_int_arg('page_webhooks', 1), per_page)
+    queues = get_page(redis_client, "queues", user_filter,
+                      get_int_arg('page_queues', 1), per_page)
+    chats = get_page(redis_client, "chats", user_filter,
+                     get_int_arg('page_chats', 1), per_page)
     
     return render_template_string(HTML, 
         webhooks=webhooks,
         queues=queues,
-        chats=chats
+        chats=chats,
+        user_filter=user_filter,
+        live_insert={
+            "webhooks": webhooks["number"] == 1,
+            "queues": queues["number"] == 1,
+            "chats": chats["number"] == 1
+        },
+        page_url=page_url
     )
 
+class ChangeFeed:
+    """Change feed único do servidor
+    
+    Uma thread observa o snapshot compartilhado e distribui deltas para
+    todos os streams SSE abertos. Sem streams abertos, a thread dorme.
+    """
+    
+    def __init__(self, interval=FEED_INTERVAL):
+        self.interval = interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.state = None
+        self.totals = {}
+        
+    def subscribe(self):
+        """Registra um stream e retorna a fila de deltas dele"""
+        stream = queue.Queue(maxsize=FEED_BACKLOG)
+        if self.totals:
+            stream.put_nowait({"totals": self.totals})
+        with self.lock:
+            self.subscribers.add(stream)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return stream
+        
+    def unsubscribe(self, stream):
+        with self.lock:
+            self.subscribers.discard(stream)
+            
+    def publish(self, delta):
+        """Envia um delta para todos os streams, derrubando os lentos
+        
+        O stream derrubado recebe FEED_CLOSED no lugar do backlog, para o
+        generate() terminar e a página se ressincronizar.
+        """
+        with self.lock:
+            for stream in list(self.subscribers):
+                try:
+                    stream.put_nowait(delta)
+                except queue.Full:
+                    print("⚠️ Stream SSE lento descartado", flush=True)
+                    self.subscribers.discard(stream)
+                    with stream.mutex:
+                        stream.queue.clear()
+                    stream.put_nowait(FEED_CLOSED)
+                    
+    def run(self):
+        """Loop da thread do feed"""
+        redis_client = connect_redis()
+        while True:
+            # Limpa antes de conferir: um subscribe() entre a conferência e o
+            # wait() deixa o evento ligado e o wait() retorna na hora
+            self.wakeup.clear()
+            with self.lock:
+                idle = not self.subscribers
+            if idle:
+                # Estado é refeito do zero quando alguém voltar a assistir
+                self.state = None
+                self.wakeup.wait()
+                continue
+                
+            try:
+                delta = self.poll(redis_client)
+                if delta:
+                    self.publish(delta)
+            except Exception as e:
+                print(f"❌ Erro no change feed: {str(e)}", flush=True)
+                
+            time.sleep(self.interval)
+            
+    def poll(self, redis_client):
+        """Compara o estado atual com o anterior e monta o delta"""
+        with _snapshot_lock:
+            keys = get_snapshot(redis_client)["keys"]
+            
+        # Tamanho das filas e dos logs de webhook (no Upstash), um round
+        # trip em cada; log que cresceu significa nova tentativa de entrega
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys["queues"]:
+            pipe.llen(key)
+        queue_sizes = pipe.execute()
+        
+        log_sizes = []
+        logs_client = connect_logs()
+        if keys["webhooks"]:
+            pipe = logs_client.pipeline(transaction=False)
+            for key in keys["webhooks"]:
+                pipe.strlen(key)
+            log_sizes = pipe.execute()
+        
+        state = {
+            "chats": set(keys["chats"]),
+            "queues": {k: size for k, size in zip(keys["queues"], queue_sizes) if size},
+            "webhooks": dict(zip(keys["webhooks"], log_sizes)),
+        }
+        totals = {
+            "webhooks": len(keys["webhooks"]),
+            "queues": len(state["queues"]),
+            "chats": len(keys["chats"]),
+        }
+        
+        previous, self.state = self.state, state
+        delta = {}
+        if totals != self.totals:
+            delta["totals"] = self.totals = totals
+        if previous is None:
+            return delta
+            
+        added = state["chats"] - previous["chats"]
+        removed = previous["chats"] - state["chats"]
+        if added:
+            delta["chats_added"] = sorted(get_user_id_from_key(k) for k in added)
+        if removed:
+            delta["chats_removed"] = sorted(get_user_id_from_key(k) for k in removed)
+            
+        changed = {
+            get_user_id_from_key(k): size
+            for k, size in state["queues"].items()
+            if previous["queues"].get(k) != size
+        }
+        removed = previous["queues"].keys() - state["queues"].keys()
+        if changed:
+            delta["queues_changed"] = changed
+        if removed:
+            delta["queues_removed"] = sorted(get_user_id_from_key(k) for k in removed)
+            
+        grown = [
+            k for k, size in state["webhooks"].items()
+            if size and size != previous["webhooks"].get(k)
+        ]
+        if grown:
+            delta["deliveries"] = self.fetch_deliveries(logs_client, grown)
+            
+        return delta
+        
+    def fetch_deliveries(self, logs_client, keys):
+        """Resume a última tentativa dos logs de webhook alterados (no Upstash)"""
+        pipe = logs_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            
+        deliveries = []
+        for key, raw in zip(keys, pipe.execute()):
+            if not raw:
+                continue
+            data = json.loads(raw)
+            attempts = data.get("attempts", [])
+            if not attempts:
+                continue
+            deliveries.append({
+                "user_id": get_user_id_from_key(key),
+                "status": attempts[-1].get("status"),
+                "timestamp": attempts[-1].get("timestamp"),
+                "index": len(attempts) - 1,
+                "total_attempts": len(attempts)
+            })
+        return deliveries
+
+feed = ChangeFeed()
+
+@app.route('/events')
+def events():
+    """Stream SSE com os deltas do change feed"""
+    stream = feed.subscribe()
+    
+    def generate():
+        try:
+            while True:
+                try:
+                    delta = stream.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if delta is FEED_CLOSED:
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                yield f"event: delta\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            feed.unsubscribe(stream)
+            
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Desativa buffer em proxies nginx
+    })
+
+@app.route('/summary')
+def summary():
+    """Resumo do sistema a partir dos contadores agregados
+    
+    Custo constante: não percorre o keyspace.
+    Parâmetros: minutes (histórico por minuto) e days (usuários distintos por dia).
+    """
+    return jsonify(read_summary(
+        connect_redis(),
+        minutes=request.args.get('minutes', 60, type=int),
+        days=request.args.get('days', 7, type=int)
+    ))
+
+def parse_time(value):
+    """Converte epoch (segundos) ou ISO-8601 para epoch"""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def query_deliveries(redis_client, status=None, user=None, since=None, until=None,
+                     cursor=None, limit=DELIVERIES_LIMIT):
+    """Busca tentativas de entrega nos índices, da mais nova para a mais antiga
+    
+    O cursor guarda a posição no índice como "score:skip" (score da última
+    tentativa devolvida e quantas tentativas com esse mesmo score já foram
+    lidas), então páginas seguintes não dependem de offset.
+    
+    Returns:
+        (tentativas, próximo cursor ou None se acabou)
+    """
+    # Escolhe o índice mais seletivo; status dentro do usuário é filtrado aqui
+    status_filter = None
+    if user:
+        key = get_webhook_index_key("user", user)
+        status_filter = status
+    elif status:
+        key = get_webhook_index_key("status", status)
+    else:
+        key = get_webhook_index_key("all")
+        
+    max_score, skip = ("+inf" if until is None else until), 0
+    if cursor:
+        score, skip = cursor.rsplit(":", 1)
+        max_score, skip = float(score), int(skip)
+    min_score = "-inf" if since is None else since
+    
+    items = []
+    for _ in range(MAX_INDEX_BATCHES):
+        batch = redis_client.zrevrangebyscore(
+            key, max_score, min_score, start=skip, num=limit, withscores=True
+        )
+        for member, score in batch:
+            if score == max_score:
+                skip += 1
+            else:
+                max_score, skip = score, 1
+                
+            entry = json.loads(member)
+            if status_filter and entry.get("status") != status_filter:
+                continue
+            entry["epoch"] = score
+            items.append(entry)
+            if len(items) >= limit:
+                return items, f"{max_score!r}:{skip}"
+                
+        if len(batch) < limit:
+            return items, None
+            
+    # Muitas tentativas descartadas pelo filtro; devolve o que achou
+    return items, f"{max_score!r}:{skip}"
+
+@app.route('/deliveries')
+def deliveries():
+    """Busca no histórico de entregas por status, período e usuário
+    
+    Parâmetros: status, user, since, until (epoch ou ISO-8601), cursor e limit.
+    """
+    status = request.args.get('status') or None
+    if status and status not in WEBHOOK_STATUSES:
+        return jsonify({"error": f"Status inválido: {status}"}), 400
+        
+    logs_client = connect_logs()
+    if logs_client is None:
+        return jsonify({"items": [], "next_cursor": None})
+        
+    try:
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+        items, next_cursor = query_deliveries(
+            logs_client,
+            status=status,
+            user=request.args.get('user') or None,
+            since=since,
+            until=until,
+            cursor=request.args.get('cursor') or None,
+            limit=get_int_arg('limit', DELIVERIES_LIMIT, MAX_DELIVERIES_LIMIT)
+        )
+    except ValueError as e:
+        return jsonify({"error": f"Parâmetro inválido: {str(e)}"}), 400
+        
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/payload/webhook/<path:user_id>')
+def webhook_payload(user_id):
+    """Payload e resposta de uma tentativa de webhook"""
+    logs_client = connect_logs()
+    raw = logs_client.get(get_webhook_key(user_id)) if logs_client else None
+    if not raw:
+        return jsonify({"error": "Log não encontrado"}), 404
+    attempts = json.loads(raw).get("attempts", [])
+    index = request.args.get('index', -1, type=int)
+    if not -len(attempts) <= index < len(attempts):
+        return jsonify({"error": "Tentativa não encontrada"}), 404
+    attempt = attempts[index]
+    return jsonify({"payload": attempt.get("payload"), "response": attempt.get("response")})
+
+@app.route('/payload/queue/<path:user_id>')
+def queue_payload(user_id):
+    """Primeiras mensagens de uma fila, sem remover"""
+    messages = connect_redis().lrange(get_queue_key(user_id), 0, QUEUE_PREVIEW - 1)
+    return jsonify([json.loads(msg) for msg in messages])
+
+@app.route('/payload/chat/<path:user_id>')
+def chat_payload(user_id):
+    """Dados completos de um chat em andamento"""
+    raw = connect_redis().get(get_data_key(user_id))
+    if not raw:
+        return jsonify({"error": "Chat não encontrado"}), 404
+    return jsonify(json.loads(raw))
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,169 @@
+"""
+Política de flush dos chats, usada pela API e pelo Monitor
+
+Um chat acumulado vai para a fila de envio quando a primeira destas
+condições acontecer:
+
+- idle: N segundos sem mensagem nova (janela deslizante, o antigo ttl)
+- max_wait: N segundos desde a primeira mensagem (0 = sem limite)
+- max_messages: o chat atingiu N mensagens (0 = sem limite)
+
+Valores vêm, nesta ordem de prioridade, do payload (ttl, max_wait,
+max_messages), da política do tenant em FLUSH_POLICIES e dos padrões
+FLUSH_IDLE, FLUSH_MAX_WAIT e FLUSH_MAX_MESSAGES.
+"""
+import json
+import os
+from datetime import datetime
+from functools import lru_cache
+from constants import (
+    DEFAULT_TTL,
+    get_data_key,
+    get_queue_key,
+    get_ttl_key
+)
+from stats import record_flush
+from profiling import span
+
+# Campo do payload -> chave da política
+POLICY_FIELDS = {
+    "ttl": "idle",
+    "max_wait": "max_wait",
+    "max_messages": "max_messages",
+}
+
+def _number(name: str, value, label: str):
+    """Converte um valor de política; label identifica a origem no erro"""
+    try:
+        return int(value) if name == "max_messages" else float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{label} não numérico ({value!r})") from None
+
+def _numeric_policy(values: dict, source: str) -> dict:
+    """Converte uma política do FLUSH_POLICIES, recusando chaves desconhecidas"""
+    unknown = set(values) - set(POLICY_FIELDS.values())
+    if unknown:
+        raise ValueError(f"{source}: chave(s) desconhecida(s) {sorted(unknown)}")
+    return {name: _number(name, value, f"{source}.{name}") for name, value in values.items()}
+
+@lru_cache(maxsize=4)
+def _parse_tenant_policies(raw: str) -> dict:
+    if not raw:
+        return {}
+    try:
+        tenants = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"FLUSH_POLICIES não é um JSON válido: {e}") from None
+    if not isinstance(tenants, dict) or not all(isinstance(v, dict) for v in tenants.values()):
+        raise ValueError('FLUSH_POLICIES deve ser um objeto {"tenant": {"idle": ...}}')
+    return {
+        tenant: _numeric_policy(values, f"FLUSH_POLICIES[{tenant!r}]")
+        for tenant, values in tenants.items()
+    }
+
+def get_tenant_policies() -> dict:
+    """Políticas por tenant, do JSON em FLUSH_POLICIES
+
+    Exemplo: {"inst_123": {"idle": 10, "max_wait": 60, "max_messages": 20}}
+    O tenant é o valor do campo FLUSH_TENANT_FIELD do payload (instance_id).
+    """
+    return _parse_tenant_policies(os.getenv('FLUSH_POLICIES', ''))
+
+def get_default_policy() -> dict:
+    return {
+        "idle": _number("idle", os.getenv('FLUSH_IDLE', DEFAULT_TTL), 'FLUSH_IDLE'),
+        "max_wait": _number("max_wait", os.getenv('FLUSH_MAX_WAIT', 0), 'FLUSH_MAX_WAIT'),
+        "max_messages": _number("max_messages", os.getenv('FLUSH_MAX_MESSAGES', 0), 'FLUSH_MAX_MESSAGES'),
+    }
+
+def validate_config():
+    """Valida as variáveis FLUSH_* na subida do serviço
+
+    Configuração inválida é erro do servidor, não do cliente: falha aqui,
+    antes de aceitar mensagens, em vez de virar 400 em toda requisição.
+
+    Raises:
+        ValueError: com a variável e o valor inválido
+    """
+    get_default_policy()
+    get_tenant_policies()
+
+def resolve_policy(payload: dict) -> dict:
+    """Monta a política efetiva para uma mensagem
+
+    A configuração já foi validada em validate_config na subida.
+
+    Raises:
+        ValueError: se algum valor de política do payload não for numérico
+    """
+    policy = get_default_policy()
+
+    tenant = payload.get(os.getenv('FLUSH_TENANT_FIELD', 'instance_id'))
+    if tenant is not None:
+        policy.update(get_tenant_policies().get(str(tenant), {}))
+
+    for field, name in POLICY_FIELDS.items():
+        if payload.get(field) is not None:
+            policy[name] = _number(name, payload[field], field)
+    return policy
+
+def start_chat(policy: dict, now: float) -> dict:
+    """Campos de controle de um chat novo (fora do metadata)"""
+    return {
+        "first_at": now,
+        "deadline": now + policy["max_wait"] if policy["max_wait"] > 0 else None
+    }
+
+def next_expiry(policy: dict, chat_data: dict, now: float) -> float:
+    """Segundos até o flush do chat; 0 significa flush imediato"""
+    max_messages = policy["max_messages"]
+    if max_messages > 0 and len(chat_data.get("messages", [])) >= max_messages:
+        return 0
+
+    expire_in = policy["idle"]
+    deadline = chat_data.get("deadline")
+    if deadline is not None:
+        expire_in = min(expire_in, deadline - now)
+    return max(0, expire_in)
+
+def build_payload(user_id: str, chat_data: dict) -> dict:
+    """Monta o payload que vai para a fila de envio"""
+    payload = {
+        "user": user_id,  # Único campo fixo que precisamos
+        "listamessages": chat_data.get("messages", []),  # Lista de mensagens
+        "processed_at": datetime.now().isoformat()  # Timestamp do processamento
+    }
+
+    # Adiciona todos os campos do metadata
+    if "metadata" in chat_data:
+        payload.update(chat_data["metadata"])
+    return payload
+
+def queue_flush(pipe, user_id: str, chat_data: dict):
+    """Adiciona ao pipeline o envio do chat para a fila e a limpeza dele
+
+    Chaves do mesmo usuário compartilham o slot em modo cluster.
+    """
+    payload = build_payload(user_id, chat_data)
+    pipe.rpush(get_queue_key(user_id), json.dumps(payload))
+    # Um DEL por chave: o pipeline do cluster não aceita DEL com várias chaves
+    pipe.delete(get_data_key(user_id))
+    pipe.delete(get_ttl_key(user_id))
+    record_flush(pipe, user_id, len(payload["listamessages"]))
+
+def flush_chat(redis_client, user_id: str) -> bool:
+    """Move o chat do usuário para a fila de envio
+
+    Returns:
+        False se o chat não existe mais
+    """
+    with span("flush.read"):
+        chat_data = redis_client.get(get_data_key(user_id))
+    if not chat_data:
+        return False
+
+    pipe = redis_client.pipeline(transaction=False)
+    queue_flush(pipe, user_id, json.loads(chat_data))
+    with span("flush.write"):
+        pipe.execute()
+    return True
@@ -3,16 +3,23 @@ import json
 from datetime import datetime
 import time
 import os
+import signal
 import sys
 import asyncio
 import aiohttp
 from dotenv import load_dotenv
 from constants import (
+    REDIS_PREFIX_DATA,
     REDIS_PREFIX_TTL,
     get_data_key,
+    get_user_id_from_key,
     get_user_id_from_ttl_key,
     get_ttl_key
 )
+from flush_policy import flush_chat
+from stats import reconcile_gauges
+from profiling import install as install_profiling, span
+from connection import get_expiry_sources, get_redis, get_upstash, safe_url
 
 # Força flush imediato dos prints
 sys.stdout.reconfigure(line_buffering=True)
@@ -25,35 +32,17 @@ load_dotenv()
 print("Carregou dotenv!", flush=True)
 
 # Conexão com Redis
-redis_client = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=int(os.getenv('REDIS_PORT', 6379)),
-    password=os.getenv('REDIS_PASSWORD'),
-    decode_responses=True
-)
+redis_client = get_redis()
 
 # URL do webhook do .env
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 
 # Cliente Redis do Upstash para logs
-upstash_url = os.getenv('UPSTASH_REDIS_URL')
-if upstash_url:
-    # Parse da URL do Upstash
-    url_parts = upstash_url.replace('redis://', '').split('@')
-    auth = url_parts[0].split(':')
-    host_port = url_parts[1].split(':')
-    
-    upstash_client = redis.Redis(
-        host=host_port[0],
-        port=int(host_port[1]),
-        password=auth[1],
-        ssl=True,
-        decode_responses=True
-    )
+upstash_client = get_upstash()
+if upstash_client:
     print("✅ Conectado ao Upstash Redis", flush=True)
 else:
     print("⚠️ UPSTASH_REDIS_URL não configurado!", flush=True)
-    upstash_client = None
 
 def save_error_log(error_type, source, error_message, details=None):
     """Salva log de erro no Upstash"""
@@ -78,10 +67,8 @@ def save_error_log(error_type, source, error_message, details=None):
         
         # Adiciona novo log e salva
         logs.append(error_data)
-        upstash_client.set(key, json.dumps(logs))
-        
         # TTL de 30 dias
-        upstash_client.expire(key, 60 * 60 * 24 * 30)
+        upstash_client.set(key, json.dumps(logs), ex=60 * 60 * 24 * 30)
         
     except Exception as e:
         print(f"[META-ERROR] Erro ao salvar log: {str(e)}", flush=True)
@@ -90,34 +77,13 @@ async def process_expired_chat(ttl_key):
     """Processa chat expirado"""
     try:
         user_id = get_user_id_from_ttl_key(ttl_key)
-        data_key = get_data_key(user_id)
         
-        # Pega dados do chat
-        chat_data = redis_client.get(data_key)
-        if not chat_data:
+        # Move o chat para a fila, limpa os dados e atualiza contadores
+        with span("monitor.process_expired_chat"):
+            flushed = flush_chat(redis_client, user_id)
+        if not flushed:
             print(f"❌ Dados não encontrados para {user_id}", flush=True)
             return
-            
-        chat_data = json.loads(chat_data)
-        
-        # Prepara payload (dinâmico)
-        payload = {
-            "user": user_id,  # Único campo fixo que precisamos
-            "listamessages": chat_data.get("messages", []),  # Lista de mensagens
-            "processed_at": datetime.now().isoformat()  # Timestamp do processamento
-        }
-        
-        # Adiciona todos os campos do metadata
-        if "metadata" in chat_data:
-            payload.update(chat_data["metadata"])
-        
-        # Adiciona na fila
-        queue_key = f"chat:QUEUE:{user_id}"
-        redis_client.rpush(queue_key, json.dumps(payload))
-        
-        # Limpa dados do chat
-        redis_client.delete(data_key)
-        redis_client.delete(ttl_key)
         
     except Exception as e:
         print(f"❌ Erro ao processar chat expirado: {str(e)}", flush=True)
@@ -126,31 +92,164 @@ async def process_expired_chat(ttl_key):
             "user_id": user_id if 'user_id' in locals() else None
         })
 
+# Intervalo para conferir mudanças de topologia do cluster (segundos)
+TOPOLOGY_CHECK_INTERVAL = 30
+
+# Chaves de dados conferidas por round trip na recuperação
+RECOVERY_BATCH = 500
+
+# Intervalo da reconciliação dos gauges de stats:* (0 desliga; varre o keyspace)
+STATS_RECONCILE_INTERVAL = float(os.getenv('STATS_RECONCILE_INTERVAL', 0))
+
+# Ligado por SIGTERM/SIGINT: o monitor termina o flush atual e sai
+stopping = False
+
+def request_stop(signame):
+    global stopping
+    if stopping:
+        return
+    print(f"\n🛑 {signame} recebido, parando de escutar expirações", flush=True)
+    stopping = True
+
+def flush_orphans(data_keys):
+    """Faz flush dos chats do lote que já não têm chave de TTL"""
+    user_ids = [get_user_id_from_key(key) for key in data_keys]
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(get_ttl_key(user_id))
+        
+    flushed = 0
+    for user_id, has_ttl in zip(user_ids, pipe.execute()):
+        if stopping:
+            break
+        if not has_ttl and flush_chat(redis_client, user_id):
+            flushed += 1
+    return flushed
+
+def recover_expired():
+    """Faz flush dos chats cuja expiração foi perdida
+    
+    Notificações de keyspace não ficam guardadas: o que expirou com o
+    monitor parado (deploy, queda, reconexão) só é encontrado aqui, como
+    dados sem a chave de TTL correspondente.
+    """
+    started = time.monotonic()
+    recovered = 0
+    batch = []
+    for data_key in redis_client.scan_iter(match=f"{REDIS_PREFIX_DATA}:*", count=RECOVERY_BATCH):
+        batch.append(data_key)
+        if len(batch) >= RECOVERY_BATCH:
+            recovered += flush_orphans(batch)
+            batch = []
+        if stopping:
+            return recovered
+    if batch:
+        recovered += flush_orphans(batch)
+        
+    if recovered:
+        print(f"♻️ {recovered} chat(s) expirado(s) sem notificação enviado(s) para a fila "
+              f"em {time.monotonic() - started:.1f}s", flush=True)
+    return recovered
+
+def reconcile_stats():
+    """Corrige os gauges (numa thread); falha aqui não derruba a escuta de expirações"""
+    started = time.monotonic()
+    try:
+        gauges = reconcile_gauges(redis_client)
+    except Exception as e:
+        print(f"⚠️ Falha ao reconciliar contadores: {e}", flush=True)
+        return
+    print(f"📊 Contadores reconciliados em {time.monotonic() - started:.1f}s: "
+          f"{gauges['stale_chats']} chat(s) fechado(s) removido(s), "
+          f"{gauges['buffered_messages']} mensagem(ns), {gauges['queue_depth']} na fila", flush=True)
+
+def node_id(source):
+    """host:porta de um cliente, para identificar o nó"""
+    kwargs = source.connection_pool.connection_kwargs
+    return f"{kwargs.get('host')}:{kwargs.get('port')}"
+
+def subscribe_expired():
+    """Assina as expirações em cada nó (todos os primários em modo cluster)
+    
+    Returns:
+        (lista de pubsubs, identificação dos nós assinados)
+    """
+    pubsubs = []
+    nodes = set()
+    for source in get_expiry_sources(redis_client):
+        kwargs = source.connection_pool.connection_kwargs
+        pubsub = source.pubsub()
+        pubsub.psubscribe(f"__keyevent@{kwargs.get('db', 0)}__:expired")
+        pubsubs.append(pubsub)
+        nodes.add(node_id(source))
+    return pubsubs, nodes
+
+def expiry_nodes():
+    """Nós que deveriam estar assinados agora"""
+    return {node_id(source) for source in get_expiry_sources(redis_client)}
+
 async def monitor():
     """Monitor principal"""
-    while True:
+    loop = asyncio.get_running_loop()
+    install_profiling("monitor", loop)
+    
+    # SIGTERM (deploy) e SIGINT: termina o chat atual e sai; o que ficar
+    # para trás é pego pela recuperação da próxima instância
+    for sig in (signal.SIGTERM, signal.SIGINT):
         try:
-            pubsub = redis_client.pubsub()
-            pubsub.psubscribe('__keyevent@0__:expired')
+            loop.add_signal_handler(sig, request_stop, sig.name)
+        except NotImplementedError:
+            pass  # Windows
             
-            print("🚀 Monitor iniciado", flush=True)
+    reconciled_at = None
+    reconciling = None
+    while not stopping:
+        pubsubs = []
+        try:
+            pubsubs, nodes = subscribe_expired()
+            checked_at = time.monotonic()
             
-            while True:
-                message = pubsub.get_message()
-                if message and message['type'] == 'pmessage':
-                    # Verifica se data já é string ou precisa decode
-                    key = message['data']
-                    if isinstance(key, bytes):
-                        key = key.decode('utf-8')
-                    
-                    print(f"\nRecebeu mensagem do Redis: {message}", flush=True)
-                    print(f"Chave expirada: {key}", flush=True)
-                    
-                    if key.startswith(f"{REDIS_PREFIX_TTL}:"):
-                        print(f"✅ Processando chat: {key}", flush=True)
-                        await process_expired_chat(key)
-                    else:
-                        print(f"❌ Chave não é do chat: {key}", flush=True)
+            print(f"🚀 Monitor iniciado ({len(nodes)} nó(s): {', '.join(sorted(nodes))})", flush=True)
+            
+            # Assinado antes de varrer, para não perder nada entre os dois
+            recover_expired()
+            
+            while not stopping:
+                for pubsub in pubsubs:
+                    # Esvazia tudo que já chegou antes de dormir
+                    while not stopping:
+                        message = pubsub.get_message()
+                        if not message:
+                            break
+                        if message['type'] != 'pmessage':
+                            continue
+                        
+                        # Verifica se data já é string ou precisa decode
+                        key = message['data']
+                        if isinstance(key, bytes):
+                            key = key.decode('utf-8')
+                        
+                        print(f"\nRecebeu mensagem do Redis: {message}", flush=True)
+                        print(f"Chave expirada: {key}", flush=True)
+                        
+                        if key.startswith(f"{REDIS_PREFIX_TTL}:"):
+                            print(f"✅ Processando chat: {key}", flush=True)
+                            await process_expired_chat(key)
+                        else:
+                            print(f"❌ Chave não é do chat: {key}", flush=True)
+                
+                # Failover ou resharding: reassina nos primários atuais
+                if time.monotonic() - checked_at >= TOPOLOGY_CHECK_INTERVAL:
+                    checked_at = time.monotonic()
+                    if expiry_nodes() != nodes:
+                        print("🔄 Topologia mudou, reassinando expirações", flush=True)
+                        break
+                
+                # Varredura numa thread: as expirações continuam sendo processadas
+                if STATS_RECONCILE_INTERVAL > 0 and (reconciling is None or reconciling.done()) and (
+                        reconciled_at is None or time.monotonic() - reconciled_at >= STATS_RECONCILE_INTERVAL):
+                    reconciled_at = time.monotonic()
+                    reconciling = loop.run_in_executor(None, reconcile_stats)
                         
                 await asyncio.sleep(0.1)
                 
@@ -162,6 +261,16 @@ async def monitor():
             # Espera 1 segundo e tenta reiniciar
             await asyncio.sleep(1)
             continue
+            
+        finally:
+            for pubsub in pubsubs:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+                    
+    print("👋 Monitor encerrado", flush=True)
+    sys.stdout.flush()
 
 if __name__ == "__main__":
     load_dotenv()
@@ -171,7 +280,7 @@ if __name__ == "__main__":
     print(f"REDIS_HOST: {os.getenv('REDIS_HOST')}", flush=True)
     print(f"REDIS_PORT: {os.getenv('REDIS_PORT')}", flush=True)
     print(f"WEBHOOK_URL: {os.getenv('WEBHOOK_URL')}", flush=True)
-    print(f"UPSTASH_REDIS_URL: {os.getenv('UPSTASH_REDIS_URL')}", flush=True)
+    print(f"UPSTASH_REDIS_URL: {safe_url(os.getenv('UPSTASH_REDIS_URL') or '')}", flush=True)
     print("==========================", flush=True)
     
     try:
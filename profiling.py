@@ -0,0 +1,218 @@
+"""
+Profiling opcional dos serviços
+
+- Spans amostrados: `with span("etapa"):` mede o tempo das etapas de uma
+  fração (PROFILE_SAMPLE_RATE) das mensagens e imprime um resumo a cada
+  PROFILE_REPORT_INTERVAL segundos. Com taxa 0 (padrão) o custo é mínimo.
+- Captura sob demanda: SIGUSR1 grava um cProfile e SIGUSR2 um snapshot do
+  tracemalloc, ambos por PROFILE_CAPTURE_SECONDS, em PROFILE_DIR.
+"""
+import contextvars
+import cProfile
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+import tracemalloc
+
+_settings = {
+    "service": "app",
+    "sample_rate": 0.0,
+    "report_interval": 60.0,
+    "capture_seconds": 10.0,
+    "directory": "profiles",
+}
+
+# Se a mensagem atual foi amostrada (None = nenhum span aberto ainda)
+_sampled = contextvars.ContextVar("profile_sampled", default=None)
+
+_stats = {}
+_stats_lock = threading.Lock()
+_last_report = [time.monotonic()]
+
+# Captura em andamento
+_capture = {"kind": None, "profile": None, "stats": None, "per_call": False}
+_capture_lock = threading.Lock()
+
+class span:
+    """Mede uma etapa se a mensagem atual foi amostrada
+
+    O primeiro span aberto decide a amostragem; os aninhados seguem a
+    mesma decisão, então uma mensagem amostrada tem todas as etapas.
+    """
+    __slots__ = ("name", "start", "token")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+        self.token = None
+
+    def __enter__(self):
+        sampled = _sampled.get()
+        if sampled is None:
+            rate = _settings["sample_rate"]
+            sampled = rate > 0 and random.random() < rate
+            self.token = _sampled.set(sampled)
+        if sampled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            _record(self.name, time.perf_counter() - self.start)
+        if self.token is not None:
+            _sampled.reset(self.token)
+        return False
+
+def _record(name: str, elapsed: float):
+    with _stats_lock:
+        entry = _stats.get(name)
+        if entry is None:
+            entry = _stats[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        entry["count"] += 1
+        entry["total"] += elapsed
+        entry["max"] = max(entry["max"], elapsed)
+
+        now = time.monotonic()
+        if now - _last_report[0] < _settings["report_interval"]:
+            return
+        _last_report[0] = now
+        report = summary()
+        _stats.clear()
+
+    print(f"\n=== PROFILE {_settings['service']} (amostra {_settings['sample_rate']:g}) ===", flush=True)
+    for name, entry in sorted(report.items()):
+        print(f"{name}: {entry['count']}x, média {entry['avg_ms']:.2f}ms, máx {entry['max_ms']:.2f}ms", flush=True)
+
+def summary() -> dict:
+    """Resumo dos spans desde o último relatório"""
+    return {
+        name: {
+            "count": entry["count"],
+            "avg_ms": entry["total"] / entry["count"] * 1000,
+            "max_ms": entry["max"] * 1000,
+        }
+        for name, entry in list(_stats.items())
+    }
+
+def _capture_path(kind: str) -> str:
+    os.makedirs(_settings["directory"], exist_ok=True)
+    name = f"{_settings['service']}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+    extension = "prof" if kind == "cpu" else "tracemalloc"
+    return os.path.join(_settings["directory"], f"{name}.{extension}")
+
+def start_capture(kind: str = "cpu", per_call: bool = False) -> bool:
+    """Inicia uma captura cpu (cProfile) ou memory (tracemalloc)
+
+    Em modo per_call (servidores com threads) cada chamada dentro de
+    profiled_call() tem seu próprio profiler e os resultados são somados;
+    senão a thread atual inteira é perfilada. Quem inicia deve chamar
+    finish_capture() na mesma thread depois de PROFILE_CAPTURE_SECONDS.
+
+    Returns:
+        False se já havia uma captura em andamento
+    """
+    with _capture_lock:
+        if _capture["kind"]:
+            return False
+        _capture.update(kind=kind, profile=None, stats=None, per_call=per_call)
+        if kind == "memory":
+            tracemalloc.start(25)
+        elif not per_call:
+            _capture["profile"] = cProfile.Profile()
+            _capture["profile"].enable()
+    print(f"🔬 Captura {kind} iniciada por {_settings['capture_seconds']:g}s", flush=True)
+    return True
+
+def finish_capture() -> str:
+    """Encerra a captura e grava o arquivo; retorna o caminho"""
+    with _capture_lock:
+        kind = _capture["kind"]
+        if not kind:
+            return None
+        path = _capture_path(kind)
+        if kind == "memory":
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(path)
+            top = snapshot.statistics("lineno")[:10]
+        else:
+            stats = _capture["stats"]
+            if _capture["profile"]:
+                _capture["profile"].disable()
+                stats = pstats.Stats(_capture["profile"])
+            if stats:
+                stats.dump_stats(path)
+            else:
+                path = None  # Nenhuma chamada perfilada no período
+            top = []
+        _capture.update(kind=None, profile=None, stats=None, per_call=False)
+
+    print(f"🔬 Captura {kind} gravada em {path}", flush=True)
+    for stat in top:
+        print(f"   {stat}", flush=True)
+    return path
+
+class profiled_call:
+    """Perfila uma chamada quando há captura cpu em modo per_call"""
+    __slots__ = ("profile",)
+
+    def __enter__(self):
+        self.profile = None
+        if _capture["per_call"] and _capture["kind"] == "cpu":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is None:
+            return False
+        self.profile.disable()
+        with _capture_lock:
+            if _capture["kind"] == "cpu":
+                if _capture["stats"] is None:
+                    _capture["stats"] = pstats.Stats(self.profile)
+                else:
+                    _capture["stats"].add(self.profile)
+        return False
+
+def capture_for(kind: str, per_call: bool = True) -> bool:
+    """Captura por PROFILE_CAPTURE_SECONDS, encerrando em uma thread à parte
+
+    Só para per_call ou memory, que não dependem da thread que iniciou.
+    """
+    if not start_capture(kind, per_call=per_call):
+        return False
+    timer = threading.Timer(_settings["capture_seconds"], finish_capture)
+    timer.daemon = True
+    timer.start()
+    return True
+
+def install(service: str, loop=None):
+    """Lê a configuração do ambiente e registra SIGUSR1 (cpu) e SIGUSR2 (memory)
+
+    Com loop (serviços asyncio) a captura cpu perfila a thread do event
+    loop inteira; sem loop ela é por chamada, via profiled_call().
+    """
+    _settings.update(
+        service=service,
+        sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+        report_interval=float(os.getenv('PROFILE_REPORT_INTERVAL', 60)),
+        capture_seconds=float(os.getenv('PROFILE_CAPTURE_SECONDS', 10)),
+        directory=os.getenv('PROFILE_DIR', 'profiles'),
+    )
+
+    if not hasattr(signal, "SIGUSR1"):
+        return  # Windows
+
+    if loop is not None:
+        def on_signal(kind):
+            if start_capture(kind):
+                loop.call_later(_settings["capture_seconds"], finish_capture)
+        loop.add_signal_handler(signal.SIGUSR1, on_signal, "cpu")
+        loop.add_signal_handler(signal.SIGUSR2, on_signal, "memory")
+    elif threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda *_: capture_for("cpu"))
+        signal.signal(signal.SIGUSR2, lambda *_: capture_for("memory"))
@@ -0,0 +1,247 @@
+"""
+Controle de admissão da API: token bucket por tenant e limite global de concorrência
+
+Tudo é decidido por um script Lua no Redis, então os limites valem para todas
+as réplicas da API juntas. Em modo cluster as chaves de rate limit dividem a
+hash tag {ratelimit}, para o script poder ler todas de uma vez. Isso é um
+limite deliberado: toda requisição passa por esse único shard, que vira o
+teto de vazão da API com o rate limit ligado (ver README).
+
+Configuração:
+- RATE_LIMIT_ENABLED: liga/desliga (padrão: ligado)
+- RATE_LIMITS: JSON por campo do payload, com rate (tokens/s), burst e
+  limites específicos por tenant, ex.:
+  {"user": {"rate": 5, "burst": 20},
+   "instance_id": {"rate": 100, "burst": 200, "tenants": {"inst_123": {"rate": 500, "burst": 1000}}}}
+- RATE_LIMIT_CONCURRENCY: requisições simultâneas em todas as réplicas (0 = sem limite)
+"""
+import json
+import math
+import os
+import uuid
+from functools import lru_cache
+import redis
+from constants import get_ratelimit_inflight_key, get_ratelimit_key
+
+DEFAULT_RATE_LIMITS = {
+    "user": {"rate": 5, "burst": 20},
+    "instance_id": {"rate": 100, "burst": 200},
+    "id_agente": {"rate": 100, "burst": 200},
+}
+
+# Tempo máximo de uma vaga de concorrência, caso a réplica morra sem liberar
+LEASE_TTL = 30
+
+# KEYS[1] sorted set de vagas (score = expiração); KEYS[2..] buckets
+# ARGV: limite de concorrência (0 = sem limite), id da vaga, ttl da vaga,
+#       e rate (tokens/s) e burst de cada bucket, na ordem das chaves
+# Retorna {permitido, segundos até ter tokens, bucket que recusou (0 = concorrência)}
+# Só consome tokens e a vaga se todos permitirem: uma requisição recusada
+# por um bucket não gasta os outros (ex.: o de instance_id compartilhado)
+ADMIT_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local limit = tonumber(ARGV[1])
+local lease_ttl = tonumber(ARGV[3])
+
+if limit > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    if redis.call('ZCARD', KEYS[1]) >= limit then
+        return {0, '1', 0}
+    end
+end
+
+local tokens = {}
+local rejected = 0
+local retry_after = 0
+for i = 2, #KEYS do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local current = tonumber(state[1])
+    local ts = tonumber(state[2])
+    if current == nil then
+        current = burst
+        ts = now
+    end
+    current = math.min(burst, current + math.max(0, now - ts) * rate)
+    if current < 1 then
+        if rejected == 0 then
+            rejected = i - 1
+        end
+        retry_after = math.max(retry_after, (1 - current) / rate)
+    end
+    tokens[i] = current
+end
+
+if rejected > 0 then
+    return {0, tostring(retry_after), rejected}
+end
+
+for i = 2, #KEYS do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', KEYS[i], 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil(burst / rate * 1000) + 1000)
+end
+
+if limit > 0 then
+    redis.call('ZADD', KEYS[1], now + lease_ttl, ARGV[2])
+    redis.call('PEXPIRE', KEYS[1], math.ceil(lease_ttl * 1000))
+end
+return {1, '0', 0}
+"""
+
+def _bucket(config, source: str) -> dict:
+    """rate e burst de um bucket, recusando valores que o script não aceita"""
+    if not isinstance(config, dict):
+        raise ValueError(f"{source} deve ser um objeto com rate e burst")
+    bucket = {}
+    for name in ("rate", "burst"):
+        try:
+            bucket[name] = float(config[name])
+        except KeyError:
+            raise ValueError(f"{source}: {name} ausente") from None
+        except (TypeError, ValueError):
+            raise ValueError(f"{source}.{name} não numérico ({config[name]!r})") from None
+    if not bucket["rate"] > 0:
+        raise ValueError(f"{source}.rate deve ser maior que 0 ({bucket['rate']:g})")
+    if not bucket["burst"] >= 1:
+        raise ValueError(f"{source}.burst deve ser pelo menos 1 ({bucket['burst']:g})")
+    return bucket
+
+@lru_cache(maxsize=4)
+def _parse_rate_limits(raw: str) -> dict:
+    if not raw:
+        limits = DEFAULT_RATE_LIMITS
+    else:
+        try:
+            limits = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"RATE_LIMITS não é um JSON válido: {e}") from None
+        if not isinstance(limits, dict):
+            raise ValueError('RATE_LIMITS deve ser um objeto {"campo": {"rate": ..., "burst": ...}}')
+
+    parsed = {}
+    for field, config in limits.items():
+        source = f"RATE_LIMITS[{field!r}]"
+        tenants = config.get("tenants", {}) if isinstance(config, dict) else {}
+        if not isinstance(tenants, dict):
+            raise ValueError(f"{source}.tenants deve ser um objeto")
+        parsed[field] = _bucket(config, source)
+        parsed[field]["tenants"] = {
+            str(value): _bucket(limit, f"{source}.tenants[{value!r}]")
+            for value, limit in tenants.items()
+        }
+    return parsed
+
+def get_rate_limits() -> dict:
+    """Limites por campo, já validados: {campo: {rate, burst, tenants: {valor: {rate, burst}}}}"""
+    return _parse_rate_limits(os.getenv('RATE_LIMITS', ''))
+
+def get_concurrency() -> int:
+    try:
+        concurrency = int(os.getenv('RATE_LIMIT_CONCURRENCY', 200))
+    except ValueError:
+        raise ValueError(f"RATE_LIMIT_CONCURRENCY não é inteiro ({os.getenv('RATE_LIMIT_CONCURRENCY')!r})") from None
+    if concurrency < 0:
+        raise ValueError(f"RATE_LIMIT_CONCURRENCY não pode ser negativo ({concurrency})")
+    return concurrency
+
+def validate_config():
+    """Valida RATE_LIMITS e RATE_LIMIT_CONCURRENCY na subida da API
+
+    Configuração inválida falha aqui, em vez de virar 500 em toda mensagem
+    (ou de deixar tudo passar, com rate 0 quebrando o script).
+
+    Raises:
+        ValueError: com a variável e o valor inválido
+    """
+    get_rate_limits()
+    get_concurrency()
+
+class RateLimiter:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.admit_sha = None
+
+    @property
+    def enabled(self) -> bool:
+        return os.getenv('RATE_LIMIT_ENABLED', 'true').lower() in ("1", "true", "yes", "on")
+
+    def load_scripts(self):
+        self.admit_sha = self.redis_client.script_load(ADMIT_SCRIPT)
+
+    def buckets_for(self, payload: dict) -> list:
+        """(campo, chave, rate, burst) de cada bucket que se aplica ao payload"""
+        buckets = []
+        for field, config in get_rate_limits().items():
+            value = payload.get(field)
+            if value is None:
+                continue
+            limit = config["tenants"].get(str(value), config)
+            buckets.append((field, get_ratelimit_key(field, str(value)),
+                            limit["rate"], limit["burst"]))
+        return buckets
+
+    def acquire(self, payload: dict) -> dict:
+        """Decide se a requisição entra, em um único round trip
+
+        Returns:
+            {"allowed": bool, "retry_after": segundos, "reason": str, "lease": id ou None}
+            Com lease, a vaga de concorrência deve ser liberada com release().
+        """
+        if not self.enabled:
+            return {"allowed": True, "lease": None}
+
+        concurrency = get_concurrency()
+        lease = uuid.uuid4().hex if concurrency > 0 else None
+        buckets = self.buckets_for(payload)
+
+        try:
+            allowed, retry_after, rejected = self._run(lease, concurrency, buckets)
+        except redis.RedisError as e:
+            # Sem Redis o limite não decide nada: deixa passar
+            print(f"⚠️ Rate limit indisponível: {str(e)}", flush=True)
+            return {"allowed": True, "lease": None}
+
+        if not allowed:
+            return {
+                "allowed": False,
+                "retry_after": float(retry_after),
+                "reason": buckets[rejected - 1][0] if rejected else "concorrência global",
+                "lease": None
+            }
+
+        return {"allowed": True, "lease": lease}
+
+    def _run(self, lease, concurrency, buckets) -> list:
+        keys = [get_ratelimit_inflight_key()] + [key for _, key, _, _ in buckets]
+        args = [concurrency if lease else 0, lease or "", LEASE_TTL]
+        for _, _, rate, burst in buckets:
+            args.extend((rate, burst))
+
+        if self.admit_sha is None:
+            self.load_scripts()
+        try:
+            return self.redis_client.evalsha(self.admit_sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            # Redis reiniciou ou failover: recarrega o script e tenta de novo
+            self.load_scripts()
+            return self.redis_client.evalsha(self.admit_sha, len(keys), *keys, *args)
+
+    def release(self, lease: str, pipe=None):
+        """Libera a vaga de concorrência (no pipeline dado, se houver)"""
+        if not lease:
+            return
+        if pipe is not None:
+            pipe.zrem(get_ratelimit_inflight_key(), lease)
+            return
+        try:
+            self.redis_client.zrem(get_ratelimit_inflight_key(), lease)
+        except redis.RedisError as e:
+            print(f"⚠️ Erro ao liberar vaga de concorrência: {str(e)}", flush=True)
+
+def retry_after_header(seconds: float) -> str:
+    """Valor do header Retry-After (segundos inteiros, mínimo 1)"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,199 @@
+"""
+Contadores agregados mantidos pelo pipeline (API, Monitor e Worker)
+
+As funções de escrita recebem um pipeline já aberto, para que os contadores
+viajem no mesmo round trip das escritas que cada serviço já faz.
+
+Chats abertos são um set de usuários (SADD/SREM idempotentes), então duas
+primeiras mensagens simultâneas contam o chat uma vez só. A profundidade da
+fila só muda quando uma mensagem entra ou sai de vez, e as filas não
+expiram (a espera do retry fica em chat:RETRY). reconcile_gauges corrige
+o que sobrar, como chaves apagadas à mão, e é opcional.
+"""
+import json
+import time
+from constants import REDIS_PREFIX_DATA, REDIS_PREFIX_INFLIGHT, REDIS_PREFIX_QUEUE, get_data_key
+
+# Gauges globais
+STATS_OPEN_CHATS = "stats:chats:open:users"        # Set dos usuários com chat aguardando expiração
+STATS_BUFFERED_MESSAGES = "stats:messages:buffered"  # Mensagens nesses chats
+STATS_QUEUE_DEPTH = "stats:queue:depth"             # Mensagens nas filas de envio
+
+# Séries temporais
+STATS_PREFIX_MINUTE = "stats:minute"  # Hash por minuto: stats:minute:{YYYYmmddHHMM}
+STATS_PREFIX_USERS = "stats:users"    # HyperLogLog por dia: stats:users:{YYYY-mm-dd}
+
+# Campos dos buckets por minuto
+MINUTE_FIELDS = ["messages", "flushed", "success", "error", "retry", "discarded"]
+
+# Retenção das séries
+MINUTE_BUCKET_TTL = 60 * 60 * 24 * 2   # 2 dias
+USERS_BUCKET_TTL = 60 * 60 * 24 * 35   # 35 dias
+MAX_HISTORY_MINUTES = 60 * 24
+MAX_HISTORY_DAYS = 30
+
+# Chaves por pipeline na reconciliação
+RECONCILE_BATCH = 500
+
+def get_minute_key(ts: float = None) -> str:
+    """Retorna a chave do bucket do minuto (UTC)"""
+    return f"{STATS_PREFIX_MINUTE}:{time.strftime('%Y%m%d%H%M', time.gmtime(ts))}"
+
+def get_users_key(ts: float = None) -> str:
+    """Retorna a chave do HyperLogLog de usuários do dia (UTC)"""
+    return f"{STATS_PREFIX_USERS}:{time.strftime('%Y-%m-%d', time.gmtime(ts))}"
+
+def _bump_minute(pipe, field: str, amount: int = 1):
+    key = get_minute_key()
+    pipe.hincrby(key, field, amount)
+    pipe.expire(key, MINUTE_BUCKET_TTL)
+
+def record_message(pipe, user_id: str):
+    """API recebeu uma mensagem"""
+    pipe.incr(STATS_BUFFERED_MESSAGES)
+    pipe.sadd(STATS_OPEN_CHATS, user_id)
+    users_key = get_users_key()
+    pipe.pfadd(users_key, user_id)
+    pipe.expire(users_key, USERS_BUCKET_TTL)
+    _bump_minute(pipe, "messages")
+
+def record_flush(pipe, user_id: str, message_count: int):
+    """Monitor moveu um chat expirado para a fila de envio"""
+    pipe.srem(STATS_OPEN_CHATS, user_id)
+    pipe.decrby(STATS_BUFFERED_MESSAGES, message_count)
+    pipe.incr(STATS_QUEUE_DEPTH)
+    _bump_minute(pipe, "flushed")
+
+def record_delivery(pipe, status: str, retried: bool = False):
+    """Worker terminou de processar uma mensagem da fila
+
+    Args:
+        status: success, error ou discarded
+        retried: se a mensagem voltou para a fila para nova tentativa
+    """
+    _bump_minute(pipe, status)
+    if retried:
+        _bump_minute(pipe, "retry")
+    else:
+        pipe.decr(STATS_QUEUE_DEPTH)
+
+def _scan_batches(redis_client, match: str = None, set_key: str = None):
+    """Chaves do padrão (SCAN, todos os nós em modo cluster) ou membros de um set (SSCAN), em lotes"""
+    if set_key:
+        items = redis_client.sscan_iter(set_key, count=RECONCILE_BATCH)
+    else:
+        items = redis_client.scan_iter(match=match, count=RECONCILE_BATCH)
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= RECONCILE_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _correct(redis_client, key: str, before: int, actual: int):
+    """Aplica a diferença como INCRBY, sem apagar o que mudou durante a varredura"""
+    if actual != before:
+        redis_client.incrby(key, actual - before)
+
+def reconcile_gauges(redis_client) -> dict:
+    """Corrige os gauges a partir das chaves (opcional, para reparo)
+
+    - open_chats: remove do set usuários sem chave chat:DATA
+    - buffered_messages: mensagens nos chats
+    - queue_depth: mensagens nas filas mais as que estão em envio (chat:INFLIGHT)
+
+    Custa um SCAN do keyspace e um GET por chat; rode fora do event loop.
+    Os contadores são lidos antes da varredura e corrigidos pela diferença,
+    então INCR/DECR feitos durante ela são mantidos. O que a varredura ver
+    só em parte pode ficar de fora; a próxima reconciliação corrige.
+
+    Returns:
+        dict com os valores encontrados
+    """
+    buffered_before = int(redis_client.get(STATS_BUFFERED_MESSAGES) or 0)
+    depth_before = int(redis_client.get(STATS_QUEUE_DEPTH) or 0)
+
+    stale = 0
+    for users in _scan_batches(redis_client, set_key=STATS_OPEN_CHATS):
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in users:
+            pipe.exists(get_data_key(user_id))
+        gone = [user_id for user_id, exists in zip(users, pipe.execute()) if not exists]
+        if gone:
+            stale += redis_client.srem(STATS_OPEN_CHATS, *gone)
+
+    buffered_messages = 0
+    for keys in _scan_batches(redis_client, f"{REDIS_PREFIX_DATA}:*"):
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        for raw in pipe.execute():
+            if raw is None:
+                continue  # Flush durante a varredura
+            try:
+                buffered_messages += len(json.loads(raw).get("messages", []))
+            except (ValueError, AttributeError):
+                pass
+
+    queue_depth = 0
+    for prefix, command in ((REDIS_PREFIX_QUEUE, "llen"), (REDIS_PREFIX_INFLIGHT, "hlen")):
+        for keys in _scan_batches(redis_client, f"{prefix}:*"):
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                getattr(pipe, command)(key)
+            queue_depth += sum(pipe.execute())
+
+    _correct(redis_client, STATS_BUFFERED_MESSAGES, buffered_before, buffered_messages)
+    _correct(redis_client, STATS_QUEUE_DEPTH, depth_before, queue_depth)
+    return {
+        "stale_chats": stale,
+        "buffered_messages": buffered_messages,
+        "queue_depth": queue_depth
+    }
+
+def read_summary(redis_client, minutes: int = 60, days: int = 7) -> dict:
+    """Lê gauges e histórico em um único round trip
+
+    O custo depende só da janela pedida, nunca do tamanho do keyspace.
+    Gauges vêm crus: valor negativo indica deriva ainda não reconciliada.
+    """
+    minutes = max(1, min(minutes, MAX_HISTORY_MINUTES))
+    days = max(1, min(days, MAX_HISTORY_DAYS))
+    now = time.time()
+    minute_keys = [get_minute_key(now - 60 * i) for i in range(minutes - 1, -1, -1)]
+    day_keys = [get_users_key(now - 86400 * i) for i in range(days - 1, -1, -1)]
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.scard(STATS_OPEN_CHATS)
+    pipe.get(STATS_BUFFERED_MESSAGES)
+    pipe.get(STATS_QUEUE_DEPTH)
+    for key in minute_keys:
+        pipe.hgetall(key)
+    for key in day_keys:
+        pipe.pfcount(key)
+    results = pipe.execute()
+
+    gauges, buckets, users = results[:3], results[3:3 + minutes], results[3 + minutes:]
+
+    history = []
+    totals = dict.fromkeys(MINUTE_FIELDS, 0)
+    for key, bucket in zip(minute_keys, buckets):
+        entry = {"minute": key.rsplit(":", 1)[-1]}
+        for field in MINUTE_FIELDS:
+            entry[field] = int(bucket.get(field, 0))
+            totals[field] += entry[field]
+        history.append(entry)
+
+    return {
+        "open_chats": int(gauges[0] or 0),
+        "buffered_messages": int(gauges[1] or 0),
+        "queue_depth": int(gauges[2] or 0),
+        "totals": totals,
+        "history": history,
+        "users_per_day": [
+            {"day": key.rsplit(":", 1)[-1], "users": count}
+            for key, count in zip(day_keys, users)
+        ]
+    }
@@ -0,0 +1,115 @@
+"""
+All-in-one: timer wheel (reagendar, cancelar, voltas), AOF com última
+linha truncada e recuperação do estado por replay
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from allinone import AllInOne, AppendOnlyFile, TimerWheel
+from flush_policy import resolve_policy
+
+@pytest.fixture
+def wheel():
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.current = 0  # Relógio fixo: tick N = segundo N
+    return wheel
+
+def test_reschedule_keeps_only_latest_deadline(wheel):
+    wheel.schedule("chat", 2)
+    wheel.schedule("chat", 4)
+
+    assert wheel.advance(3) == []
+    assert wheel.advance(4) == ["chat"]
+    assert wheel.advance(10) == []
+
+def test_cancel(wheel):
+    wheel.schedule("chat", 2)
+    wheel.cancel("chat")
+
+    assert wheel.advance(5) == []
+    assert wheel.deadlines == {}
+
+def test_delays_longer_than_the_wheel(wheel):
+    # 8 slots: o tick 19 cai no mesmo slot do 3 e precisa esperar duas voltas
+    wheel.schedule("longe", 19)
+    wheel.schedule("perto", 3)
+
+    assert wheel.advance(10) == ["perto"]
+    assert wheel.advance(18) == []
+    assert wheel.advance(19) == ["longe"]
+
+def test_past_deadline_fires_on_next_advance(wheel):
+    wheel.advance(5)
+    wheel.schedule("atrasado", 1)
+    assert wheel.advance(6) == ["atrasado"]
+
+def test_replay_skips_truncated_last_line(tmp_path):
+    path = tmp_path / "allinone.aof"
+    path.write_text('{"op": "done", "id": 1}\n{"op": "done", "id": 2}\n{"op": "do', encoding="utf-8")
+
+    assert AppendOnlyFile(str(path)).replay() == [{"op": "done", "id": 1}, {"op": "done", "id": 2}]
+
+@pytest.fixture
+def aof_env(monkeypatch, tmp_path):
+    path = tmp_path / "allinone.aof"
+    monkeypatch.setenv("ALLINONE_STORE", "aof")
+    monkeypatch.setenv("ALLINONE_AOF_PATH", str(path))
+    monkeypatch.delenv("UPSTASH_REDIS_URL", raising=False)
+    return path
+
+def restored():
+    """Nova instância com o estado recuperado do AOF"""
+    app = AllInOne()
+
+    async def restore():
+        app.deliveries = asyncio.Queue()
+        await app.restore()
+
+    asyncio.run(restore())
+    return app
+
+def test_replay_message_flush_retry_done(aof_env):
+    # Cada etapa é gravada e o processo "reinicia" a partir do AOF
+    app = AllInOne()
+    app.aof.rewrite([])
+    now = time.time()
+    for text in ("oi", "tudo bem?"):
+        payload = {"user": "joao", "message": text, "instance_id": "inst_1"}
+        policy = resolve_policy(payload)
+        app.record({"op": "msg", "payload": payload, "policy": policy, "ts": now})
+        app.add_message(payload, policy, now)
+    app.aof.close()
+
+    app = restored()
+    assert app.chats["joao"]["messages"] == ["oi", "tudo bem?"]
+    assert ("chat", "joao") in app.wheel.deadlines
+
+    item = app.flush("joao")
+    app.record({"op": "flush", "user": "joao", "id": item["id"], "payload": item["payload"]})
+    app.aof.close()
+
+    app = restored()
+    assert app.chats == {}
+    assert app.pending[item["id"]]["payload"]["listamessages"] == ["oi", "tudo bem?"]
+    assert app.pending[item["id"]]["payload"]["instance_id"] == "inst_1"
+    assert app.deliveries.qsize() == 1  # Envio pendente volta para a fila
+
+    app.record({"op": "retry", "id": item["id"], "retry_count": 1})
+    app.aof.close()
+
+    app = restored()
+    assert app.pending[item["id"]]["retry_count"] == 1
+
+    app.done(app.pending[item["id"]])
+    app.aof.close()
+
+    app = restored()
+    assert app.pending == {} and app.chats == {}
+    assert app.deliveries.qsize() == 0
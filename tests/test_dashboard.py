@@ -0,0 +1,102 @@
+"""
+Dashboard sem Upstash (seção de webhooks vazia) e paginação por cursor
+no histórico de entregas
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import dashboard
+from constants import get_webhook_index_key
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+@pytest.fixture
+def no_upstash(monkeypatch, client):
+    monkeypatch.setattr(dashboard, "connect_redis", lambda: client)
+    monkeypatch.setattr(dashboard, "get_upstash", lambda: None)
+    monkeypatch.setitem(dashboard._snapshot, "keys", None)
+    return dashboard.app.test_client()
+
+def test_page_without_upstash(no_upstash, client):
+    client.set("chat:DATA:joao", json.dumps({"metadata": {}, "messages": ["oi"]}))
+    client.rpush("chat:QUEUE:maria", json.dumps({"user": "maria"}))
+
+    response = no_upstash.get("/")
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert "joao" in page and "maria" in page
+
+def test_deliveries_without_upstash(no_upstash):
+    response = no_upstash.get("/deliveries?status=success")
+    assert response.status_code == 200
+    assert response.get_json() == {"items": [], "next_cursor": None}
+
+def add_attempt(client, user, status, ts):
+    entry = json.dumps({"user_id": user, "status": status, "index": int(ts)})
+    client.zadd(get_webhook_index_key("all"), {entry: ts})
+    client.zadd(get_webhook_index_key("status", status), {entry: ts})
+    client.zadd(get_webhook_index_key("user", user), {entry: ts})
+
+def read_all(client, **filters):
+    pages, cursor = [], None
+    while True:
+        items, cursor = dashboard.query_deliveries(client, cursor=cursor, limit=2, **filters)
+        pages.append(items)
+        if cursor is None:
+            return pages
+
+def test_cursor_paging_with_equal_scores(client):
+    # Três tentativas no mesmo segundo atravessam a borda da página
+    for i, ts in enumerate([100, 100, 100, 101, 102]):
+        add_attempt(client, f"u{i}", "success", ts)
+
+    pages = read_all(client)
+    items = [item for page in pages for item in page]
+    assert [item["epoch"] for item in items] == [102, 101, 100, 100, 100]
+    assert len({item["user_id"] for item in items}) == 5
+    assert all(len(page) <= 2 for page in pages)
+
+def test_cursor_paging_filters_status_inside_user(client):
+    for ts, status in enumerate(["error", "success", "error", "error", "success"]):
+        add_attempt(client, "joao", status, ts)
+
+    items = [item for page in read_all(client, user="joao", status="error") for item in page]
+    assert [item["epoch"] for item in items] == [3, 2, 0]
+
+def test_cursor_paging_time_window(client):
+    for ts in range(10):
+        add_attempt(client, "joao", "success", ts)
+
+    items = [item for page in read_all(client, since=3, until=6) for item in page]
+    assert [item["epoch"] for item in items] == [6, 5, 4, 3]
+
+def test_feed_reads_grown_logs_from_upstash(monkeypatch, client):
+    logs = fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    monkeypatch.setattr(dashboard, "get_upstash", lambda: logs)
+    feed = dashboard.ChangeFeed()
+
+    def poll():
+        monkeypatch.setitem(dashboard._snapshot, "keys", None)
+        return feed.poll(client)
+
+    log = {"attempts": [{"status": "error", "timestamp": "t1"}]}
+    logs.set("webhook:user:joao", json.dumps(log))
+    poll()
+
+    log["attempts"].append({"status": "success", "timestamp": "t2"})
+    logs.set("webhook:user:joao", json.dumps(log))
+    delta = poll()
+
+    assert delta["deliveries"] == [{
+        "user_id": "joao", "status": "success", "timestamp": "t2",
+        "index": 1, "total_attempts": 2
+    }]
@@ -0,0 +1,34 @@
+"""
+Configuração FLUSH_* inválida é erro de subida; só valores do payload
+viram ValueError por mensagem (400 na API)
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from flush_policy import resolve_policy, validate_config
+
+@pytest.mark.parametrize("env, value", [
+    ("FLUSH_POLICIES", "{inst_1: 10}"),
+    ("FLUSH_POLICIES", '["inst_1"]'),
+    ("FLUSH_POLICIES", '{"inst_1": {"idle": "dez"}}'),
+    ("FLUSH_POLICIES", '{"inst_1": {"idel": 10}}'),
+    ("FLUSH_IDLE", "quinze"),
+])
+def test_invalid_config_fails_at_startup(monkeypatch, env, value):
+    monkeypatch.setenv(env, value)
+    with pytest.raises(ValueError, match=env):
+        validate_config()
+
+def test_tenant_and_payload_policy(monkeypatch):
+    monkeypatch.setenv("FLUSH_POLICIES", '{"inst_1": {"idle": 10, "max_messages": 20}}')
+    validate_config()
+
+    policy = resolve_policy({"instance_id": "inst_1", "max_wait": "60"})
+    assert policy == {"idle": 10.0, "max_wait": 60.0, "max_messages": 20}
+
+    with pytest.raises(ValueError, match="ttl"):
+        resolve_policy({"instance_id": "inst_1", "ttl": "abc"})
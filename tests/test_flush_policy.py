@@ -0,0 +1,29 @@
+"""
+queue_flush precisa funcionar no pipeline do Redis Cluster, que recusa
+comandos multi-chave como DEL com várias chaves
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from redis.cluster import ClusterPipeline
+from flush_policy import queue_flush
+
+def cluster_pipeline():
+    # Só enfileira comandos; sem execute() não precisa de um cluster de verdade
+    return ClusterPipeline(nodes_manager=None, commands_parser=None)
+
+def test_queue_flush_in_cluster_pipeline(monkeypatch):
+    monkeypatch.setenv("REDIS_CLUSTER", "true")
+    pipe = cluster_pipeline()
+
+    queue_flush(pipe, "joao", {"messages": ["oi"], "metadata": {"instance_id": "inst_1"}})
+
+    commands = [command.args for command in pipe.command_stack]
+    assert commands[0][:2] == ("RPUSH", "chat:QUEUE:{joao}")
+    assert ("DEL", "chat:DATA:{joao}") in commands
+    assert ("DEL", "chat:TTL:{joao}") in commands
+    # Todas as chaves do usuário no mesmo slot
+    user_keys = [args[1] for args in commands if "{joao}" in str(args[1])]
+    assert len(user_keys) == 3
@@ -0,0 +1,59 @@
+"""
+Rate limit: uma requisição recusada não pode gastar tokens dos outros buckets
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # Scripts Lua no fakeredis
+
+from ratelimit import RateLimiter, validate_config
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setenv("RATE_LIMITS", '{"user": {"rate": 0.001, "burst": 2}, "instance_id": {"rate": 0.001, "burst": 3}}')
+    monkeypatch.setenv("RATE_LIMIT_CONCURRENCY", "0")
+    return RateLimiter(fakeredis.FakeRedis(decode_responses=True))
+
+def test_rejected_request_does_not_spend_shared_bucket(limiter):
+    noisy = {"user": "barulhento", "instance_id": "inst_1"}
+    results = [limiter.acquire(noisy)["allowed"] for _ in range(6)]
+    assert results == [True, True, False, False, False, False]
+
+    # Sobrou 1 token no instance_id para o vizinho
+    decision = limiter.acquire({"user": "vizinho", "instance_id": "inst_1"})
+    assert decision["allowed"]
+
+    decision = limiter.acquire({"user": "outro", "instance_id": "inst_1"})
+    assert not decision["allowed"]
+    assert decision["reason"] == "instance_id"
+    assert decision["retry_after"] > 0
+
+def test_concurrency_lease(limiter, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_CONCURRENCY", "1")
+    first = limiter.acquire({"user": "a"})
+    assert first["allowed"] and first["lease"]
+
+    second = limiter.acquire({"user": "b"})
+    assert not second["allowed"]
+    assert second["reason"] == "concorrência global"
+
+    limiter.release(first["lease"])
+    assert limiter.acquire({"user": "b"})["allowed"]
+
+@pytest.mark.parametrize("env, value, error", [
+    ("RATE_LIMITS", "{user: 1}", "JSON"),
+    ("RATE_LIMITS", '{"user": {"burst": 20}}', "rate ausente"),
+    ("RATE_LIMITS", '{"user": {"rate": 0, "burst": 20}}', "rate deve ser maior que 0"),
+    ("RATE_LIMITS", '{"user": {"rate": 5, "burst": 0.5}}', "burst deve ser pelo menos 1"),
+    ("RATE_LIMITS", '{"user": {"rate": 5, "burst": 20, "tenants": {"vip": {"rate": "muito", "burst": 1}}}}', "vip"),
+    ("RATE_LIMIT_CONCURRENCY", "muitas", "RATE_LIMIT_CONCURRENCY"),
+])
+def test_invalid_config_fails_at_startup(monkeypatch, env, value, error):
+    monkeypatch.setenv(env, value)
+    with pytest.raises(ValueError, match=error):
+        validate_config()
@@ -0,0 +1,64 @@
+"""
+Gauges sem deriva na origem (chats abertos como set, filas que não
+expiram), reconciliação opcional e read_summary com valores crus
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from stats import (
+    STATS_BUFFERED_MESSAGES,
+    STATS_OPEN_CHATS,
+    STATS_QUEUE_DEPTH,
+    read_summary,
+    reconcile_gauges,
+    record_flush,
+    record_message
+)
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+def gauges(client):
+    summary = read_summary(client, minutes=1, days=1)
+    return summary["open_chats"], summary["buffered_messages"], summary["queue_depth"]
+
+def run(client, record, *args):
+    pipe = client.pipeline(transaction=False)
+    record(pipe, *args)
+    pipe.execute()
+
+def test_concurrent_first_messages_count_one_chat(client):
+    # Duas requisições viram "primeira mensagem" ao mesmo tempo
+    run(client, record_message, "joao")
+    run(client, record_message, "joao")
+    assert gauges(client) == (1, 2, 0)
+
+    run(client, record_flush, "joao", 2)
+    assert gauges(client) == (0, 0, 1)
+    # Flush repetido não deixa o gauge negativo
+    run(client, record_flush, "joao", 0)
+    assert gauges(client)[0] == 0
+
+def test_reconcile_from_keys(client):
+    client.sadd(STATS_OPEN_CHATS, "joao", "apagado")
+    client.set(STATS_BUFFERED_MESSAGES, 5)
+    client.set(STATS_QUEUE_DEPTH, 4)
+
+    client.set("chat:DATA:joao", json.dumps({"metadata": {}, "messages": ["a", "b"]}))
+    client.rpush("chat:QUEUE:ana", "m1", "m2")
+    client.hset("chat:INFLIGHT:ana", "c1", json.dumps({"worker": "w1", "message": "m0"}))
+
+    assert reconcile_gauges(client) == {"stale_chats": 1, "buffered_messages": 2, "queue_depth": 3}
+    assert gauges(client) == (1, 2, 3)
+
+def test_summary_does_not_hide_drift(client):
+    client.set(STATS_QUEUE_DEPTH, -2)
+    assert gauges(client)[2] == -2
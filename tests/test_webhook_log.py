@@ -0,0 +1,43 @@
+"""
+Logs de webhook vão para o Upstash por um cliente asyncio, sem travar o
+event loop (no all-in-one é o mesmo loop que recebe as mensagens)
+"""
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from constants import get_webhook_index_key, get_webhook_key
+from worker import WebhookWorker
+
+def test_save_webhook_log_async(monkeypatch):
+    monkeypatch.delenv("UPSTASH_REDIS_URL", raising=False)
+    worker = WebhookWorker()
+    logs = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    worker.upstash_client = object()  # Upstash configurado
+    worker.logs_client = logs
+
+    async def scenario():
+        await worker.save_webhook_log("joao", {"user": "joao"}, "error", {"status": 500, "body": "x"})
+        await worker.save_webhook_log("joao", {"user": "joao"}, "success", {"status": 200, "body": "ok"})
+        return (
+            await logs.get(get_webhook_key("joao")),
+            await logs.zrange(get_webhook_index_key("status", "success"), 0, -1)
+        )
+
+    raw, success = asyncio.run(scenario())
+    log = json.loads(raw)
+    assert [attempt["status"] for attempt in log["attempts"]] == ["error", "success"]
+    assert json.loads(success[0])["index"] == 1
+
+def test_save_webhook_log_without_upstash(monkeypatch):
+    monkeypatch.delenv("UPSTASH_REDIS_URL", raising=False)
+    worker = WebhookWorker()
+    asyncio.run(worker.save_webhook_log("joao", {}, "success"))
+    assert worker.logs_client is None
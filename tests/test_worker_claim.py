@@ -0,0 +1,57 @@
+"""
+Tirar da fila e registrar em andamento (e o caminho de volta) são atômicos
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # Scripts Lua no fakeredis
+
+from worker import CLAIM_SCRIPT, REQUEUE_SCRIPT
+
+CLAIM_KEYS = ["chat:QUEUE:joao", "chat:INFLIGHT:joao", "chat:RETRY:joao"]
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+def test_claim_registers_message(client):
+    client.rpush("chat:QUEUE:joao", "m1", "m2")
+    claim = client.register_script(CLAIM_SCRIPT)
+
+    assert claim(keys=CLAIM_KEYS, args=["c1", "worker-1"]) == "m1"
+    entry = json.loads(client.hget("chat:INFLIGHT:joao", "c1"))
+    assert entry == {"worker": "worker-1", "message": "m1"}
+    assert client.lrange("chat:QUEUE:joao", 0, -1) == ["m2"]
+
+def test_claim_empty_queue(client):
+    claim = client.register_script(CLAIM_SCRIPT)
+    assert claim(keys=CLAIM_KEYS, args=["c1", "worker-1"]) is None
+    assert not client.exists("chat:INFLIGHT:joao")
+
+def test_requeue_goes_to_front_once(client):
+    client.rpush("chat:QUEUE:joao", "m1", "m2")
+    client.register_script(CLAIM_SCRIPT)(keys=CLAIM_KEYS, args=["c1", "worker-1"])
+    requeue = client.register_script(REQUEUE_SCRIPT)
+
+    assert requeue(keys=["chat:INFLIGHT:joao", "chat:QUEUE:joao"], args=["c1"]) == 1
+    assert requeue(keys=["chat:INFLIGHT:joao", "chat:QUEUE:joao"], args=["c1"]) == 0
+    assert client.lrange("chat:QUEUE:joao", 0, -1) == ["m1", "m2"]
+    assert not client.exists("chat:INFLIGHT:joao")
+
+def test_claim_waits_for_retry_delay(client):
+    # A espera do retry fica fora da fila: expirar a fila apagaria as mensagens
+    client.rpush("chat:QUEUE:joao", "m1")
+    client.set("chat:RETRY:joao", "", ex=30)
+    claim = client.register_script(CLAIM_SCRIPT)
+
+    assert claim(keys=CLAIM_KEYS, args=["c1", "worker-1"]) is None
+    assert client.lrange("chat:QUEUE:joao", 0, -1) == ["m1"]
+
+    client.delete("chat:RETRY:joao")
+    assert claim(keys=CLAIM_KEYS, args=["c1", "worker-1"]) == "m1"
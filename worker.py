@@ -4,15 +4,31 @@ import asyncio
 import aiohttp
 import time
 import os
+import signal
+import socket
 import sys
+import uuid
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from constants import (
+    REDIS_PREFIX_INFLIGHT,
+    REDIS_PREFIX_QUEUE,
     REDIS_PREFIX_TTL,
+    WEBHOOK_LOG_TTL,
+    WORKER_REGISTRY_KEY,
     get_data_key,
     get_user_id_from_ttl_key,
-    get_ttl_key
+    get_ttl_key,
+    get_user_id_from_key,
+    get_webhook_key,
+    get_webhook_index_key,
+    get_inflight_key,
+    get_queue_key,
+    get_retry_key
 )
+from stats import record_delivery
+from connection import get_async_redis, get_redis, get_upstash, get_upstash_url, safe_url
+from profiling import install as install_profiling, span
 
 # Força flush imediato dos prints
 sys.stdout.reconfigure(line_buffering=True)
@@ -20,6 +36,35 @@ sys.stdout.reconfigure(line_buffering=True)
 # Timezone Brasil (UTC-3)
 BR_TIMEZONE = timezone(timedelta(hours=-3))
 
+# KEYS[1] fila, KEYS[2] envios em andamento do usuário, KEYS[3] espera do retry;
+# ARGV: claim, worker_id
+# Tira a próxima mensagem e registra como em andamento no mesmo passo, para
+# que uma queda do worker entre os dois não perca a mensagem. Fila em espera
+# de retry não é lida.
+CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return false
+end
+local message = redis.call('LPOP', KEYS[1])
+if not message then
+    return false
+end
+redis.call('HSET', KEYS[2], ARGV[1], cjson.encode({worker = ARGV[2], message = message}))
+return message
+"""
+
+# KEYS[1] envios em andamento do usuário, KEYS[2] fila; ARGV: claim
+# Devolve a mensagem para a frente da fila; só um worker consegue, se dois tentarem
+REQUEUE_SCRIPT = """
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if not entry then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('LPUSH', KEYS[2], cjson.decode(entry).message)
+return 1
+"""
+
 class WebhookWorker:
     def __init__(self):
         self.max_slots = 50  # Aumentado para 50 mensagens simultâneas
@@ -32,39 +77,15 @@ class WebhookWorker:
         load_dotenv()
         
         # Conexão com Redis
-        self.redis_client = redis.Redis(
-            host=os.getenv('REDIS_HOST', 'localhost'),
-            port=int(os.getenv('REDIS_PORT', 6379)),
-            password=os.getenv('REDIS_PASSWORD'),
-            decode_responses=True
-        )
+        self.redis_client = get_redis()
         
         # Cliente Redis do Upstash para logs
-        upstash_url = os.getenv('UPSTASH_REDIS_URL')
         print(f"\n=== CONFIGURANDO UPSTASH ===", flush=True)
-        if upstash_url and "upstash.io" in upstash_url:
+        upstash_url = get_upstash_url()
+        if upstash_url:
             try:
-                print(f"URL Upstash: {upstash_url}", flush=True)
-                url_parts = upstash_url.replace('redis://', '').split('@')
-                auth = url_parts[0].split(':')
-                host_port = url_parts[1].split(':')
-                
-                print(f"Host: {host_port[0]}", flush=True)
-                print(f"Port: {host_port[1]}", flush=True)
-                print(f"Username: {auth[0]}", flush=True)
-                
-                self.upstash_client = redis.Redis(
-                    host=host_port[0],
-                    port=int(host_port[1]),
-                    username=auth[0],
-                    password=auth[1],
-                    decode_responses=True,
-                    socket_timeout=5,
-                    socket_connect_timeout=5,
-                    retry_on_timeout=True,
-                    ssl=True,  # Upstash requer SSL
-                    ssl_cert_reqs=None  # Não valida certificado
-                )
+                print(f"URL Upstash: {safe_url(upstash_url)}", flush=True)
+                self.upstash_client = get_upstash()
                 
                 # Testa conexão
                 if self.upstash_client.ping():
@@ -77,12 +98,53 @@ class WebhookWorker:
                 # Continua sem Upstash
                 self.upstash_client = None
         else:
-            print("⚠️ URL do Upstash não configurada ou inválida", flush=True)
+            print("⚠️ URL do Upstash não configurada", flush=True)
             self.upstash_client = None
         
         self.webhook_url = os.getenv('WEBHOOK_URL', '').rstrip('/')
         
-    def save_webhook_log(self, user_id: str, payload: dict, status: str, response: dict = None):
+        # Sessão HTTP reaproveitada entre envios (criada dentro do event loop)
+        self.session = None
+        # Cliente asyncio do Upstash para os logs (criado dentro do event loop):
+        # gravar log não pode travar o loop, que no all-in-one também recebe mensagens
+        self.logs_client = None
+        
+        # Mensagens em andamento ficam registradas no Redis até terminar, para
+        # que outro worker as devolva à fila se este morrer no meio
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.claim_script = self.redis_client.register_script(CLAIM_SCRIPT)
+        self.requeue_script = self.redis_client.register_script(REQUEUE_SCRIPT)
+        self.tasks = {}  # task -> (claim, fila)
+        self.stopping = False
+        self.shutdown_timeout = float(os.getenv('SHUTDOWN_TIMEOUT', 8))
+        self.heartbeat_interval = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', 5))
+        self.dead_after = float(os.getenv('WORKER_DEAD_AFTER', 30))
+        
+    def get_session(self) -> aiohttp.ClientSession:
+        """Sessão HTTP compartilhada, com keep-alive para o webhook"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_slots)
+            )
+        return self.session
+        
+    def get_logs_client(self):
+        """Cliente asyncio do Upstash, ou None se não configurado"""
+        if not self.upstash_client:
+            return None
+        if self.logs_client is None:
+            self.logs_client = get_async_redis(get_upstash_url())
+        return self.logs_client
+        
+    async def close(self):
+        """Fecha a sessão HTTP e o cliente de logs"""
+        if self.session:
+            await self.session.close()
+        if self.logs_client:
+            await self.logs_client.aclose()
+            self.logs_client = None
+            
+    async def save_webhook_log(self, user_id: str, payload: dict, status: str, response: dict = None):
         """Salva log do webhook no Upstash
         
         Args:
@@ -91,12 +153,16 @@ class WebhookWorker:
             status: Status do envio (sending, success, error, discarded)
             response: Resposta do webhook (opcional)
         """
+        logs_client = self.get_logs_client()
+        if not logs_client:
+            return
+            
         try:
             # Chave única por usuário
-            key = f"webhook:user:{user_id}"
+            key = get_webhook_key(user_id)
             
             # Pega logs existentes ou cria novo
-            current_logs = self.upstash_client.get(key)
+            current_logs = await logs_client.get(key)
             if current_logs:
                 logs = json.loads(current_logs)
             else:
@@ -107,8 +173,9 @@ class WebhookWorker:
                 }
             
             # Adiciona nova tentativa
+            now = time.time()
             attempt = {
-                "timestamp": datetime.now(BR_TIMEZONE).isoformat(),
+                "timestamp": datetime.fromtimestamp(now, BR_TIMEZONE).isoformat(),
                 "payload": payload,
                 "status": status
             }
@@ -117,13 +184,43 @@ class WebhookWorker:
                 attempt["response"] = response
                 
             logs["attempts"].append(attempt)
-            logs["updated_at"] = datetime.now(BR_TIMEZONE).isoformat()
+            logs["updated_at"] = attempt["timestamp"]
             logs["total_attempts"] = len(logs["attempts"])
             
-            # Salva no Upstash
-            self.upstash_client.set(key, json.dumps(logs))
+            # Entrada dos índices: resumo da tentativa, sem payload
+            # (o payload completo continua no log do usuário, pelo index)
+            entry = {
+                "user_id": user_id,
+                "index": len(logs["attempts"]) - 1,
+                "status": status,
+                "timestamp": attempt["timestamp"]
+            }
+            if response:
+                if "status" in response:
+                    entry["http_status"] = response["status"]
+                if "error" in response:
+                    entry["error"] = str(response["error"])[:200]
+            entry = json.dumps(entry, separators=(',', ':'))
+            
+            status_index = get_webhook_index_key("status", status)
+            user_index = get_webhook_index_key("user", user_id)
+            all_index = get_webhook_index_key("all")
+            cutoff = now - WEBHOOK_LOG_TTL
+            
+            # Salva log e índices no Upstash em um único round trip
+            pipe = logs_client.pipeline(transaction=False)
             # Expira em 2 dias
-            self.upstash_client.expire(key, 60 * 60 * 24 * 2)
+            pipe.set(key, json.dumps(logs), ex=WEBHOOK_LOG_TTL)
+            pipe.zadd(all_index, {entry: now})
+            pipe.zadd(status_index, {entry: now})
+            pipe.zadd(user_index, {entry: now})
+            # Remove do índice o que já expirou junto com os logs
+            pipe.zremrangebyscore(all_index, "-inf", cutoff)
+            pipe.zremrangebyscore(status_index, "-inf", cutoff)
+            pipe.zremrangebyscore(user_index, "-inf", cutoff)
+            pipe.expire(user_index, WEBHOOK_LOG_TTL)
+            with span("worker.save_log"):
+                await pipe.execute()
             
             print(f"📝 Log salvo para usuário {user_id} - Status: {status}", flush=True)
             
@@ -137,39 +234,38 @@ class WebhookWorker:
             print(f"URL: {self.webhook_url}", flush=True)
             print(f"Payload: {json.dumps(payload, indent=2)}", flush=True)
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.webhook_url, json=payload) as response:
-                    print("\nIniciando request...\n", flush=True)
-                    
-                    # Lê resposta
-                    response_json = None
-                    try:
-                        response_json = await response.json()
-                    except:
-                        response_json = await response.text()
-                        
-                    print(f"\nResposta do webhook:", flush=True)
-                    print(f"Status: {response.status}", flush=True)
-                    print(f"Body: {response_json}", flush=True)
-                    
-                    # Salva log apenas quando recebe resposta
-                    self.save_webhook_log(
-                        user_id=user_id,
-                        payload=payload,
-                        status="success" if response.status == 200 else "error",
-                        response={
-                            "status": response.status,
-                            "body": response_json
-                        }
-                    )
+            async with self.get_session().post(self.webhook_url, json=payload) as response:
+                print("\nIniciando request...\n", flush=True)
+                
+                # Lê resposta
+                response_json = None
+                try:
+                    response_json = await response.json()
+                except:
+                    response_json = await response.text()
                     
-                    return response.status == 200
+                print(f"\nResposta do webhook:", flush=True)
+                print(f"Status: {response.status}", flush=True)
+                print(f"Body: {response_json}", flush=True)
+                
+                # Salva log apenas quando recebe resposta
+                await self.save_webhook_log(
+                    user_id=user_id,
+                    payload=payload,
+                    status="success" if response.status == 200 else "error",
+                    response={
+                        "status": response.status,
+                        "body": response_json
+                    }
+                )
+                
+                return response.status == 200
                     
         except Exception as e:
             print(f"❌ Erro ao enviar webhook: {str(e)}", flush=True)
             
             # Salva log de erro
-            self.save_webhook_log(
+            await self.save_webhook_log(
                 user_id=user_id,
                 payload=payload,
                 status="error",
@@ -177,9 +273,14 @@ class WebhookWorker:
             )
             return False
             
-    async def process_message(self, queue_key: str, message_data: dict):
+    def release_claim(self, pipe, user_id: str, claim: str):
+        """Tira a mensagem do registro de andamento (no pipeline dado)"""
+        if claim:
+            pipe.hdel(get_inflight_key(user_id), claim)
+            
+    async def process_message(self, queue_key: str, message_data: dict, claim: str = None):
         """Processa uma mensagem da fila"""
-        user_id = queue_key.split(':')[2]  # chat:QUEUE:USER_ID
+        user_id = get_user_id_from_key(queue_key)  # chat:QUEUE:USER_ID
         
         try:
             self.active_slots += 1
@@ -191,7 +292,7 @@ class WebhookWorker:
             # Se passou do limite, descarta
             if retry_count >= self.max_retries:
                 print(f"❌ Descartando mensagem após {retry_count} tentativas", flush=True)
-                self.save_webhook_log(
+                await self.save_webhook_log(
                     user_id=user_id,
                     payload=message_data,
                     status="discarded",
@@ -200,12 +301,20 @@ class WebhookWorker:
                         "retry_count": retry_count
                     }
                 )
+                pipe = self.redis_client.pipeline(transaction=False)
+                record_delivery(pipe, "discarded")
+                self.release_claim(pipe, user_id, claim)
+                pipe.execute()
                 return
             
             # Tenta enviar
-            success = await self.send_webhook(user_id, message_data)
+            with span("worker.send_webhook"):
+                success = await self.send_webhook(user_id, message_data)
             
-            if not success:
+            pipe = self.redis_client.pipeline(transaction=False)
+            if success:
+                record_delivery(pipe, "success")
+            else:
                 # Incrementa contador
                 message_data['retry_count'] = retry_count + 1
                 
@@ -214,9 +323,12 @@ class WebhookWorker:
                 print(f"⚠️ Tentativa {message_data['retry_count']}/{self.max_retries} - Próximo retry em {delay}s", flush=True)
                 
                 # Devolve pra fila
-                self.redis_client.rpush(queue_key, json.dumps(message_data))
-                # Define quando pode tentar de novo
-                self.redis_client.expire(queue_key, delay)
+                pipe.rpush(queue_key, json.dumps(message_data))
+                # Define quando pode tentar de novo (expirar a fila apagaria as mensagens)
+                pipe.set(get_retry_key(user_id), "", ex=delay)
+                record_delivery(pipe, "error", retried=True)
+            self.release_claim(pipe, user_id, claim)
+            pipe.execute()
                 
         except Exception as e:
             print(f"❌ Erro ao processar mensagem: {str(e)}", flush=True)
@@ -231,12 +343,16 @@ class WebhookWorker:
                 print(f"⚠️ Tentativa {message_data['retry_count']}/{self.max_retries} - Próximo retry em {delay}s", flush=True)
                 
                 # Devolve pra fila
-                self.redis_client.rpush(queue_key, json.dumps(message_data))
-                # Define quando pode tentar de novo
-                self.redis_client.expire(queue_key, delay)
+                pipe = self.redis_client.pipeline(transaction=False)
+                pipe.rpush(queue_key, json.dumps(message_data))
+                # Define quando pode tentar de novo (expirar a fila apagaria as mensagens)
+                pipe.set(get_retry_key(user_id), "", ex=delay)
+                record_delivery(pipe, "error", retried=True)
+                self.release_claim(pipe, user_id, claim)
+                pipe.execute()
             else:
                 print(f"❌ Descartando mensagem após {retry_count + 1} tentativas", flush=True)
-                self.save_webhook_log(
+                await self.save_webhook_log(
                     user_id=user_id,
                     payload=message_data,
                     status="discarded",
@@ -246,39 +362,165 @@ class WebhookWorker:
                         "last_error": str(e)
                     }
                 )
+                pipe = self.redis_client.pipeline(transaction=False)
+                record_delivery(pipe, "discarded")
+                self.release_claim(pipe, user_id, claim)
+                pipe.execute()
             
         finally:
             self.active_slots -= 1
             self.processing.discard(user_id)
             
+    def heartbeat(self, full: bool = False):
+        """Marca este worker como vivo e recupera mensagens de workers mortos"""
+        self.redis_client.zadd(WORKER_REGISTRY_KEY, {self.worker_id: time.time()})
+        self.recover_orphans(full)
+        
+    async def heartbeat_loop(self):
+        while not self.stopping:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"❌ Erro no heartbeat: {str(e)}", flush=True)
+                
+    def requeue(self, user_id: str, claim: str) -> int:
+        """Devolve uma mensagem em andamento à frente da fila (0 se já foi devolvida)"""
+        return self.requeue_script(keys=[get_inflight_key(user_id), get_queue_key(user_id)], args=[claim])
+        
+    def recover_orphans(self, full: bool = False) -> int:
+        """Devolve à frente das filas as mensagens em andamento de workers mortos
+        
+        Um worker é considerado morto sem heartbeat há WORKER_DEAD_AFTER segundos.
+        A varredura dos envios em andamento só acontece quando algum morreu,
+        ou sempre com full (na subida do worker).
+        """
+        cutoff = time.time() - self.dead_after
+        dead = self.redis_client.zrangebyscore(WORKER_REGISTRY_KEY, "-inf", cutoff)
+        if not dead and not full:
+            return 0
+        alive = set(self.redis_client.zrangebyscore(WORKER_REGISTRY_KEY, cutoff, "+inf"))
+        
+        recovered = 0
+        for key in self.redis_client.scan_iter(match=f"{REDIS_PREFIX_INFLIGHT}:*", count=500):
+            user_id = get_user_id_from_key(key)
+            for claim, entry in self.redis_client.hgetall(key).items():
+                if json.loads(entry)["worker"] not in alive:
+                    recovered += self.requeue(user_id, claim)
+        if dead:
+            self.redis_client.zrem(WORKER_REGISTRY_KEY, *dead)
+            
+        if recovered:
+            print(f"♻️ {recovered} mensagem(ns) de workers mortos devolvida(s) às filas", flush=True)
+        return recovered
+        
+    def claim(self, queue_key: str):
+        """Tira a próxima mensagem da fila e registra como em andamento, atomicamente
+        
+        Returns:
+            (claim, mensagem decodificada) ou None
+        """
+        claim = uuid.uuid4().hex
+        user_id = get_user_id_from_key(queue_key)
+        message = self.claim_script(
+            keys=[queue_key, get_inflight_key(user_id), get_retry_key(user_id)],
+            args=[claim, self.worker_id]
+        )
+        if not message:
+            return None
+            
+        try:
+            return claim, json.loads(message)
+        except:
+            print(f"❌ Mensagem inválida: {message}", flush=True)
+            pipe = self.redis_client.pipeline(transaction=False)
+            record_delivery(pipe, "discarded")
+            self.release_claim(pipe, user_id, claim)
+            pipe.execute()
+            return None
+            
+    def request_stop(self, signame: str):
+        """Para de pegar mensagens; as em andamento são drenadas no fim do run()"""
+        if self.stopping:
+            return
+        print(f"\n🛑 {signame} recebido, parando de pegar mensagens", flush=True)
+        self.stopping = True
+        
+    def hand_back(self, entries: list):
+        """Devolve mensagens não terminadas à frente das suas filas"""
+        for claim, queue_key in entries:
+            self.requeue(get_user_id_from_key(queue_key), claim)
+        print(f"↩️ {len(entries)} mensagem(ns) devolvida(s) à fila", flush=True)
+        
+    async def drain(self):
+        """Espera as entregas em andamento por até SHUTDOWN_TIMEOUT e devolve o resto"""
+        handed_back = True
+        if self.tasks:
+            print(f"⏳ Aguardando {len(self.tasks)} entrega(s) em andamento "
+                  f"(até {self.shutdown_timeout:g}s)", flush=True)
+            _, pending = await asyncio.wait(list(self.tasks), timeout=self.shutdown_timeout)
+            if pending:
+                unfinished = [self.tasks[task] for task in pending]
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                try:
+                    self.hand_back(unfinished)
+                except Exception as e:
+                    # Continuam registradas em andamento; sem sair do registro de
+                    # workers, este é dado como morto e outro worker as recupera
+                    print(f"❌ Erro ao devolver mensagens: {str(e)}", flush=True)
+                    handed_back = False
+                    
+        if handed_back:
+            try:
+                self.redis_client.zrem(WORKER_REGISTRY_KEY, self.worker_id)
+            except Exception as e:
+                print(f"❌ Erro ao sair do registro de workers: {str(e)}", flush=True)
+            
+        await self.close()
+        print("👋 Worker encerrado", flush=True)
+        sys.stdout.flush()
+        
     async def run(self):
         """Loop principal do worker"""
         print("=== INICIANDO WORKER ===", flush=True)
+        print(f"ID: {self.worker_id}", flush=True)
+        loop = asyncio.get_running_loop()
+        install_profiling("worker", loop)
+        
+        # SIGTERM (deploy) e SIGINT: para de pegar mensagens e drena
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+            except NotImplementedError:
+                pass  # Windows
+                
+        # Recuperação antes de pegar mensagens novas
+        self.heartbeat(full=True)
+        heartbeat_task = asyncio.create_task(self.heartbeat_loop())
         
-        while True:
+        while not self.stopping:
             try:
                 # Se tem slots livres
                 if self.active_slots < self.max_slots:
-                    # Procura filas com mensagens
-                    queues = self.redis_client.keys("chat:QUEUE:*")
+                    # Procura filas com mensagens (SCAN percorre todos os nós em modo cluster)
+                    queues = self.redis_client.scan_iter(match=f"{REDIS_PREFIX_QUEUE}:*", count=500)
                     
                     for queue in queues:
                         # Pega próxima mensagem
-                        message = self.redis_client.lpop(queue)
-                        if not message:
-                            continue
-                            
-                        try:
-                            message_data = json.loads(message)
-                        except:
-                            print(f"❌ Mensagem inválida: {message}", flush=True)
+                        claimed = self.claim(queue)
+                        if not claimed:
                             continue
+                        claim, message_data = claimed
                             
                         # Cria task pra processar
-                        asyncio.create_task(self.process_message(queue, message_data))
+                        task = asyncio.create_task(self.process_message(queue, message_data, claim))
+                        self.tasks[task] = (claim, queue)
+                        task.add_done_callback(self.tasks.pop)
                         
-                        # Se lotou os slots, para
-                        if self.active_slots >= self.max_slots:
+                        # Se lotou os slots ou vai desligar, para
+                        if self.active_slots >= self.max_slots or self.stopping:
                             break
                             
                 # Pequeno delay antes de checar novamente
@@ -289,6 +531,9 @@ class WebhookWorker:
                 # Continua executando mesmo com erro
                 await asyncio.sleep(1)
                 
+        heartbeat_task.cancel()
+        await self.drain()
+                
 if __name__ == "__main__":
     # Inicia worker
     worker = WebhookWorker()